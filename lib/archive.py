@@ -0,0 +1,48 @@
+import gzip
+import os
+import tarfile
+import tempfile
+
+from fileutil import file_sha256
+
+
+def write_tarball(target, members, compresslevel=6, perms=0o644, uid=-1,
+                  gid=-1):
+    '''Write a gzip compressed tar file of the members, a list of archive
+    name and file path pairs, streaming each file in to the archive. The
+    members are sorted and the times and owners are fixed so the same files
+    always produce the same archive. The archive is written to a temporary
+    file and renamed over the target.'''
+    directory = os.path.dirname(target)
+    fd, temp = tempfile.mkstemp(prefix='.{0}.'.format(
+        os.path.basename(target)), dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            # An empty file name and zero mtime keep the gzip header fixed.
+            with gzip.GzipFile(filename='', mode='wb', fileobj=stream,
+                               compresslevel=compresslevel, mtime=0) as gz:
+                with tarfile.open(fileobj=gz, mode='w',
+                                  format=tarfile.GNU_FORMAT) as tar:
+                    for name, path in sorted(members):
+                        info = tarfile.TarInfo(name)
+                        info.size = os.path.getsize(path)
+                        info.mode = os.stat(path).st_mode & 0o777
+                        info.mtime = 0
+                        with open(path, 'rb') as member:
+                            tar.addfile(info, member)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.chmod(temp, perms)
+        if uid != -1 or gid != -1:
+            os.chown(temp, uid, gid)
+        os.rename(temp, target)
+    except Exception:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def members_digest(members):
+    '''Return a dictionary of the archive names and the SHA-256 digests of
+    the member files, used to tell if the archive must be built again.'''
+    return {name: file_sha256(path) for name, path in members}
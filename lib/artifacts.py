@@ -0,0 +1,247 @@
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from http.client import HTTPException
+from urllib.error import HTTPError
+from urllib.request import Request
+from urllib.request import urlopen
+
+from fileutil import atomic_write
+from fileutil import file_sha256
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ArtifactError(Exception):
+    '''Raised when an artifact can not be fetched or fails verification. '''
+    pass
+
+
+class ChecksumError(ArtifactError):
+    '''Raised when a fetched artifact does not match the expected checksum.
+    '''
+    pass
+
+
+class ArtifactCache(object):
+    '''A directory of downloaded files keyed by name, version and
+    architecture. Every file is verified with a SHA-256 checksum and the least
+    recently used files are removed when the cache grows over max_bytes. '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self._load_index()
+
+    def get(self, name, version, arch, sha256=None):
+        '''Return the path to the cached artifact or None when it is not in
+        the cache or does not match the expected checksum. '''
+        key = cache_key(name, version, arch)
+        entry = self.index.get(key)
+        if not entry:
+            return None
+        path = os.path.join(self.directory, entry['file'])
+        # An explicit checksum must match the one recorded for the artifact.
+        if sha256 and sha256.lower() != entry['sha256']:
+            return None
+        if not os.path.isfile(path) or file_sha256(path) != entry['sha256']:
+            # The file is missing or damaged, forget about it.
+            self._remove(key)
+            self._save_index()
+            return None
+        entry['used'] = time.time()
+        self._save_index()
+        return path
+
+    def fetch(self, name, version, arch, source, sha256=None):
+        '''Copy the artifact from the source in to the cache and return the
+        path. The source is a http(s) url or a local file path. Interrupted
+        downloads continue from where they stopped on the next call.'''
+        key = cache_key(name, version, arch)
+        partial = os.path.join(self.directory, key + '.part')
+        if source.startswith('http://') or source.startswith('https://'):
+            download(source, partial)
+        else:
+            copy_file(source, partial)
+        digest = file_sha256(partial)
+        if sha256 and sha256.lower() != digest:
+            os.remove(partial)
+            message = 'The {0} checksum {1} does not match {2}'
+            raise ChecksumError(message.format(key, digest, sha256))
+        os.chmod(partial, 0o755)
+        os.rename(partial, os.path.join(self.directory, key))
+        self.index[key] = {'file': key,
+                           'sha256': digest,
+                           'size': os.path.getsize(
+                               os.path.join(self.directory, key)),
+                           'used': time.time()}
+        self.evict(keep=key)
+        self._save_index()
+        return os.path.join(self.directory, key)
+
+    def evict(self, keep=None):
+        '''Remove the least recently used artifacts until the cache is within
+        the size limit, the artifact named by keep is never removed.'''
+        total = sum(entry['size'] for entry in self.index.values())
+        oldest = sorted(self.index.items(), key=lambda item: item[1]['used'])
+        for key, entry in oldest:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            total -= entry['size']
+
+    def _remove(self, key):
+        '''Remove the artifact file and the index entry for the key.'''
+        entry = self.index.pop(key)
+        path = os.path.join(self.directory, entry['file'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _load_index(self):
+        '''Return the index from disk, or an empty index.'''
+        try:
+            with open(self.index_path) as stream:
+                return json.load(stream)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self):
+        '''Write the index to disk atomically.'''
+        atomic_write(self.index_path, json.dumps(self.index, sort_keys=True))
+
+
+def cache_key(name, version, arch):
+    '''Return the file name used in the cache for the artifact.'''
+    return '{0}-{1}-{2}'.format(name, version, arch)
+
+
+def download(url, path, timeout=60):
+    '''Download the url to the path, resuming a partial download that is
+    already at the path when the server supports range requests and still has
+    the file the partial download started from. Raise ArtifactError when the
+    download fails.'''
+    try:
+        for attempt in range(2):
+            try:
+                if _download(url, path, timeout):
+                    return
+            except HTTPError as error:
+                # 416 means the partial file is not shorter than the file on
+                # the server, it is complete or from a different file.
+                if error.code != 416 or attempt:
+                    raise
+            # Start again from the beginning of the file.
+            discard_partial(path)
+    except (HTTPException, OSError) as error:
+        # URLError, HTTPError and socket timeouts are all OSErrors.
+        raise ArtifactError('Failed to download {0}: {1}'.format(url, error))
+
+
+def _download(url, path, timeout):
+    '''Download the url to the path, continuing the partial download when
+    the validator saved with it is for the same url. Return False when the
+    server did not continue the partial download where it stopped.'''
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    validator = load_validator(path, url) if offset else None
+    request = Request(url)
+    if validator:
+        request.add_header('Range', 'bytes={0}-'.format(offset))
+        # The server sends the whole file when it changed since the partial
+        # download started.
+        request.add_header('If-Range', validator)
+    response = urlopen(request, timeout=timeout)
+    with response:
+        if validator and response.status == 206:
+            if range_start(response.getheader('Content-Range')) != offset:
+                return False
+            mode = 'ab'
+        else:
+            # The server sent the whole file, remember the version it sent so
+            # an interrupted download only continues with the same file.
+            save_validator(path, url, response.getheader('ETag') or
+                           response.getheader('Last-Modified'))
+            mode = 'wb'
+        with open(path, mode) as stream:
+            shutil.copyfileobj(response, stream, CHUNK_SIZE)
+    # The file is complete, it is never continued.
+    remove_validator(path)
+    return True
+
+
+def range_start(content_range):
+    '''Return the first byte of a "bytes first-last/length" Content-Range
+    header, or None when the header is missing or malformed.'''
+    try:
+        unit, span = content_range.split()
+        return int(span.split('-')[0]) if unit == 'bytes' else None
+    except (AttributeError, ValueError):
+        return None
+
+
+def load_validator(path, url):
+    '''Return the ETag or Last-Modified value saved with the partial
+    download at the path when it was downloaded from the url.'''
+    try:
+        with open(path + '.validator') as stream:
+            saved = json.load(stream)
+    except (IOError, ValueError):
+        return None
+    return saved.get('validator') if saved.get('url') == url else None
+
+
+def save_validator(path, url, validator):
+    '''Save the validator of the download at the path, without a validator
+    the download can not be continued safely.'''
+    if validator:
+        atomic_write(path + '.validator', json.dumps({'url': url,
+                                                     'validator': validator}))
+    else:
+        remove_validator(path)
+
+
+def remove_validator(path):
+    '''Remove the validator saved with the download at the path.'''
+    if os.path.exists(path + '.validator'):
+        os.remove(path + '.validator')
+
+
+def discard_partial(path):
+    '''Remove the partial download at the path and its validator.'''
+    if os.path.exists(path):
+        os.remove(path)
+    remove_validator(path)
+
+
+def copy_file(source, path):
+    '''Copy a local file to the path.'''
+    if not os.path.isfile(source):
+        raise ArtifactError('The source {0} does not exist'.format(source))
+    shutil.copyfile(source, path)
+
+
+def install(source, target, perms=0o755):
+    '''Put the artifact at the target path with one atomic rename, using a
+    hard link when the cache and the target are on the same filesystem.'''
+    directory = os.path.dirname(target)
+    fd, temp = tempfile.mkstemp(prefix='.{0}.'.format(
+        os.path.basename(target)), dir=directory)
+    os.close(fd)
+    os.remove(temp)
+    try:
+        os.link(source, temp)
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        # Hard links do not work across filesystems, copy the file instead.
+        shutil.copyfile(source, temp)
+    os.chmod(temp, perms)
+    os.rename(temp, target)
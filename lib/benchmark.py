@@ -0,0 +1,195 @@
+import re
+import time
+
+from urllib.parse import quote
+
+from cadvisor import Reservoir
+from cadvisor import parse_timestamp
+from kubeapi import collection_path
+from kubeapi import object_path
+from kubeapi import pod_ready
+
+# The lines of the ApacheBench report that are returned as results.
+AB_RESULTS = {
+    'requests-per-second': r'Requests per second:\s+([\d.]+)',
+    'time-per-request-ms': r'Time per request:\s+([\d.]+) \[ms\] \(mean\)',
+    'complete-requests': r'Complete requests:\s+(\d+)',
+    'failed-requests': r'Failed requests:\s+(\d+)',
+    'transfer-kbytes-per-second': r'Transfer rate:\s+([\d.]+)',
+}
+# The percentage served within a time table at the end of the report.
+AB_PERCENTILE = re.compile(r'^\s+(50|90|99)%\s+(\d+)', re.MULTILINE)
+
+
+class BenchmarkError(Exception):
+    '''Raised when the benchmark objects do not reach the expected state. '''
+    pass
+
+
+class ClusterBenchmark(object):
+    '''Run the benchmark workloads in one namespace of the cluster through a
+    KubeClient and measure how long the cluster takes to run them. '''
+
+    def __init__(self, client, namespace, timeout=300, interval=1):
+        self.client = client
+        self.namespace = namespace
+        self.timeout = timeout
+        self.interval = interval
+
+    def pods_path(self, selector=None):
+        '''Return the path of the pods in the namespace with the labels.'''
+        path = '/api/v1/namespaces/{0}/pods'.format(self.namespace)
+        if selector:
+            path += '?labelSelector=' + quote(selector)
+        return path
+
+    def wait(self, check, description):
+        '''Call check until it returns a true value and return the value and
+        the seconds it took, raise BenchmarkError after the timeout.'''
+        start = time.time()
+        deadline = start + self.timeout
+        while True:
+            result = check()
+            if result:
+                return result, time.time() - start
+            if time.time() >= deadline:
+                raise BenchmarkError('Timed out after {0} seconds waiting '
+                                     'for {1}'.format(self.timeout,
+                                                      description))
+            time.sleep(self.interval)
+
+    def ready_pods(self, selector, count):
+        '''Return the pods with the labels when count of them are ready.'''
+        pods = self.client.get(self.pods_path(selector))['items']
+        ready = [pod for pod in pods if pod_ready(pod)]
+        if len(ready) >= count:
+            return ready
+
+    def create_namespace(self):
+        '''Create the namespace the benchmark objects run in.'''
+        self.client.create('/api/v1/namespaces', {
+            'apiVersion': 'v1', 'kind': 'Namespace',
+            'metadata': {'name': self.namespace}})
+
+    def delete_namespace(self):
+        '''Delete the namespace and every benchmark object in it.'''
+        self.client.delete('/api/v1/namespaces/{0}'.format(self.namespace))
+
+    def pod_startup(self, manifests):
+        '''Create the pods at the same time and return the percentiles of the
+        scheduling, image pull and ready latencies in seconds.'''
+        for manifest in manifests:
+            self.client.create(self.pods_path(), manifest)
+        selector = 'app={0}'.format(
+            manifests[0]['metadata']['labels']['app'])
+        pods, elapsed = self.wait(
+            lambda: self.ready_pods(selector, len(manifests)),
+            '{0} pods to be ready'.format(len(manifests)))
+        latencies = {name: Reservoir() for name in ('scheduling',
+                                                    'image-pull', 'ready')}
+        for pod in pods:
+            for name, seconds in pod_latencies(pod).items():
+                latencies[name].add(seconds)
+        result = {name: reservoir.percentiles()
+                  for name, reservoir in latencies.items()}
+        result['count'] = len(pods)
+        result['all-ready-seconds'] = elapsed
+        return result
+
+    def scale(self, manifests, replicas, scale_to):
+        '''Create the replication controller and service, then return the
+        seconds it took to start the replicas and to scale them up to
+        scale_to and back down.'''
+        for manifest in manifests:
+            self.client.create(collection_path(manifest), manifest)
+        controller = [m for m in manifests
+                      if m['kind'] == 'ReplicationController'][0]
+        path = object_path(controller)
+        selector = ','.join('{0}={1}'.format(key, value) for key, value in
+                            sorted(controller['spec']['selector'].items()))
+        result = {}
+        _, result['start-seconds'] = self.wait(
+            lambda: self.ready_pods(selector, replicas),
+            '{0} replicas to be ready'.format(replicas))
+        self.client.patch(path, {'spec': {'replicas': scale_to}})
+        _, result['scale-up-seconds'] = self.wait(
+            lambda: self.ready_pods(selector, scale_to),
+            '{0} replicas to be ready'.format(scale_to))
+        self.client.patch(path, {'spec': {'replicas': replicas}})
+        _, result['scale-down-seconds'] = self.wait(
+            lambda: self.pod_count(selector) == replicas,
+            '{0} replicas to remain'.format(replicas))
+        return result
+
+    def pod_count(self, selector):
+        '''Return the number of pods with the labels that are not being
+        deleted.'''
+        pods = self.client.get(self.pods_path(selector))['items']
+        return len([pod for pod in pods
+                    if not pod['metadata'].get('deletionTimestamp')])
+
+    def service_ip(self, name):
+        '''Return the cluster IP address of the service.'''
+        path = '/api/v1/namespaces/{0}/services/{1}'.format(self.namespace,
+                                                            name)
+        service = self.client.get(path)
+        return service['spec']['clusterIP']
+
+    def load(self, manifest):
+        '''Run the load generator pod to completion and return the results
+        parsed from its log.'''
+        self.client.create(self.pods_path(), manifest)
+        path = object_path(manifest)
+
+        def finished():
+            phase = self.client.get(path)['status'].get('phase')
+            return phase if phase in ('Succeeded', 'Failed') else None
+
+        phase, elapsed = self.wait(finished, 'the load generator to finish')
+        status, reason, log = self.client.request('GET', path + '/log')
+        if phase == 'Failed' or not isinstance(log, str):
+            raise BenchmarkError('The load generator failed: {0}'.format(
+                log if isinstance(log, str) else reason))
+        result = parse_ab(log)
+        result['run-seconds'] = elapsed
+        return result
+
+
+def pod_latencies(pod):
+    '''Return the seconds from creation until the pod was scheduled, from
+    scheduling until the containers started (the image pull) and from
+    creation until the pod was ready.'''
+    status = pod['status']
+    created = parse_timestamp(pod['metadata']['creationTimestamp'])
+    conditions = {c['type']: c for c in status.get('conditions') or []}
+    # Older apiservers have no PodScheduled condition, the kubelet start
+    # time is the closest to the scheduling time then.
+    if 'PodScheduled' in conditions:
+        scheduled = conditions['PodScheduled']['lastTransitionTime']
+    else:
+        scheduled = status['startTime']
+    scheduled = parse_timestamp(scheduled)
+    started = [parse_timestamp(c['state']['running']['startedAt'])
+               for c in status.get('containerStatuses') or []
+               if 'running' in c.get('state', {})]
+    ready = parse_timestamp(conditions['Ready']['lastTransitionTime'])
+    return {
+        'scheduling': scheduled - created,
+        'image-pull': max(started or [scheduled]) - scheduled,
+        'ready': ready - created,
+    }
+
+
+def parse_ab(log):
+    '''Return the throughput and latency results of an ApacheBench report.'''
+    result = {}
+    for name, pattern in AB_RESULTS.items():
+        match = re.search(pattern, log)
+        if match:
+            value = match.group(1)
+            result[name] = float(value) if '.' in value else int(value)
+    if 'requests-per-second' not in result:
+        raise BenchmarkError('The load generator did not report results')
+    result['latency-ms'] = {'p{0}'.format(percentile): int(value) for
+                            percentile, value in AB_PERCENTILE.findall(log)}
+    return result
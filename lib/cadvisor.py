@@ -0,0 +1,246 @@
+import codecs
+import json
+import random
+import re
+import threading
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import datetime
+from http.client import HTTPConnection
+
+# The cAdvisor API that returns the stats of every docker container.
+DOCKER_API = '/api/v1.3/docker/'
+PERCENTILES = (50, 90, 99)
+# The metric names reported for every node, container and the cluster.
+METRICS = ('cpu-millicores', 'memory-bytes', 'network-bytes-per-second',
+           'filesystem-bytes')
+
+
+class Reservoir(object):
+    '''Keep a uniform random sample of at most size values so percentiles
+    can be estimated from any number of values in constant memory. '''
+
+    def __init__(self, size=512, seed=0):
+        self.size = size
+        self.count = 0
+        self.values = []
+        self.random = random.Random(seed)
+        # The cluster reservoirs are shared by the worker threads.
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        '''Add a value to the sample.'''
+        with self.lock:
+            self.count += 1
+            if len(self.values) < self.size:
+                self.values.append(value)
+            else:
+                index = self.random.randint(0, self.count - 1)
+                if index < self.size:
+                    self.values[index] = value
+
+    def percentiles(self, percentiles=PERCENTILES):
+        '''Return a dictionary of the nearest rank percentiles.'''
+        values = sorted(self.values)
+        result = {}
+        for percentile in percentiles:
+            if values:
+                rank = int(round(percentile / 100.0 * (len(values) - 1)))
+                result['p{0}'.format(percentile)] = values[rank]
+        return result
+
+
+def iter_object_items(stream, chunk_size=64 * 1024):
+    '''Yield the key and decoded value of each member of the JSON object in
+    the stream, reading it in chunks so only one member is in memory at a
+    time.'''
+    reader = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    eof = False
+    expect = '{'
+    while True:
+        # Skip the whitespace and separators between the members.
+        while position < len(buffer) and buffer[position] in ' \t\r\n,:':
+            position += 1
+        if position < len(buffer):
+            character = buffer[position]
+            if expect == '{':
+                if character != '{':
+                    raise ValueError('The stream is not a JSON object')
+                position += 1
+                expect = 'key'
+                continue
+            if character == '}' and expect == 'key':
+                return
+            end = _value_end(buffer, position, eof)
+            if end is not None:
+                value = json.loads(buffer[position:end])
+                position = end
+                if expect == 'key':
+                    key = value
+                    expect = 'value'
+                else:
+                    yield key, value
+                    expect = 'key'
+                    # Drop the members that were already returned.
+                    buffer = buffer[position:]
+                    position = 0
+                continue
+        if eof:
+            raise ValueError('The JSON object ended early')
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer += reader.decode(chunk or b'', final=eof)
+
+
+def _value_end(buffer, start, eof):
+    '''Return the index after the JSON value that starts at start, or None
+    when the buffer does not contain all of the value yet.'''
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(buffer)):
+        character = buffer[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif character == '\\':
+                escaped = True
+            elif character == '"':
+                in_string = False
+                if depth == 0:
+                    return index + 1
+        elif character == '"':
+            in_string = True
+        elif character in '{[':
+            depth += 1
+        elif character in '}]':
+            if depth == 0:
+                # The end of the enclosing object ends a scalar value.
+                return index
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        elif depth == 0 and character in ', \t\r\n':
+            return index
+    # A scalar at the very end of the stream is complete.
+    if eof and depth == 0 and not in_string:
+        return len(buffer)
+    return None
+
+
+def parse_timestamp(timestamp):
+    '''Return the seconds since the epoch of a RFC 3339 cAdvisor timestamp,
+    the nanoseconds are truncated to microseconds.'''
+    match = re.match(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?', timestamp)
+    seconds = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    fraction = float(match.group(2) or 0)
+    return (seconds - datetime(1970, 1, 1)).total_seconds() + fraction
+
+
+def container_samples(stats):
+    '''Yield a dictionary of the metric values for each pair of consecutive
+    stats samples of one container.'''
+    previous = None
+    for sample in stats:
+        time = parse_timestamp(sample['timestamp'])
+        network = sample.get('network') or {}
+        current = {
+            'time': time,
+            'cpu': (sample.get('cpu') or {}).get('usage', {}).get('total', 0),
+            'network': network.get('rx_bytes', 0) + network.get('tx_bytes', 0),
+        }
+        if previous and time > previous['time']:
+            elapsed = time - previous['time']
+            memory = sample.get('memory') or {}
+            filesystems = sample.get('filesystem') or []
+            yield {
+                # The cpu usage is in nanoseconds of cpu time.
+                'cpu-millicores': (current['cpu'] - previous['cpu']) /
+                elapsed / 1e6,
+                'memory-bytes': memory.get('working_set',
+                                           memory.get('usage', 0)),
+                'network-bytes-per-second': (current['network'] -
+                                             previous['network']) / elapsed,
+                'filesystem-bytes': sum(fs.get('usage', 0)
+                                        for fs in filesystems),
+            }
+        previous = current
+
+
+def container_name(key, container):
+    '''Return a name for the container that can be used in an action key.'''
+    aliases = container.get('aliases') or [key]
+    name = re.sub(r'[^a-z0-9]+', '-', aliases[0].lower()).strip('-')
+    return name[:40] or 'root'
+
+
+def summarize_node(stream, cluster, sample_size=512):
+    '''Reduce the cAdvisor docker stats in the stream to percentiles for the
+    node and for each container, and add the values to the cluster
+    reservoirs.'''
+    node = {metric: Reservoir(sample_size) for metric in METRICS}
+    containers = {}
+    for key, container in iter_object_items(stream):
+        reservoirs = {metric: Reservoir(sample_size) for metric in METRICS}
+        for sample in container_samples(container.get('stats') or []):
+            for metric, value in sample.items():
+                reservoirs[metric].add(value)
+                node[metric].add(value)
+                cluster[metric].add(value)
+        containers[container_name(key, container)] = {
+            metric: reservoir.percentiles()
+            for metric, reservoir in reservoirs.items()}
+    summary = {metric: reservoir.percentiles()
+               for metric, reservoir in node.items()}
+    summary['containers'] = containers
+    return summary
+
+
+def fetch_node(host, port, timeout, cluster):
+    '''Stream the docker container stats from cAdvisor on the host and return
+    the node summary.'''
+    connection = HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', DOCKER_API)
+        response = connection.getresponse()
+        if response.status != 200:
+            raise IOError('cAdvisor returned {0} {1}'.format(
+                response.status, response.reason))
+        return summarize_node(response, cluster)
+    finally:
+        connection.close()
+
+
+def collect(hosts, report, port=8088, timeout=10, workers=8):
+    '''Query cAdvisor on the hosts concurrently with at most workers requests
+    in flight. The report callback is called with the host and the node
+    summary, or the host and the exception, as each host finishes. Return
+    the cluster percentiles.'''
+    cluster = {metric: Reservoir() for metric in METRICS}
+    hosts = iter(hosts)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while True:
+            # Keep the pool busy without queueing every host at once.
+            for host in hosts:
+                future = executor.submit(fetch_node, host, port, timeout,
+                                         cluster)
+                running[future] = host
+                if len(running) >= workers:
+                    break
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                host = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = error
+                report(host, result)
+    return {metric: reservoir.percentiles()
+            for metric, reservoir in cluster.items()}
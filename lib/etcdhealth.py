@@ -0,0 +1,76 @@
+import json
+import socket
+import ssl
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPSConnection
+from urllib.parse import urlparse
+
+
+def split_endpoints(connection_string):
+    '''Return the list of endpoints in an etcd connection string.'''
+    return [endpoint.strip() for endpoint in connection_string.split(',')
+            if endpoint.strip()]
+
+
+def probe(endpoint, timeout=2, ca=None, key=None, cert=None):
+    '''Return the seconds the etcd member at the endpoint took to answer the
+    health check, or None when it is unhealthy or does not answer in time.'''
+    url = urlparse(endpoint)
+    start = time.time()
+    connection = None
+    try:
+        if url.scheme == 'https':
+            context = ssl.create_default_context(cafile=ca)
+            if key and cert:
+                context.load_cert_chain(cert, key)
+            connection = HTTPSConnection(url.hostname, url.port or 2379,
+                                         timeout=timeout, context=context)
+        else:
+            connection = HTTPConnection(url.hostname, url.port or 2379,
+                                        timeout=timeout)
+        connection.request('GET', '/health')
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            return None
+        health = json.loads(data.decode('utf-8')).get('health')
+    except (HTTPException, socket.error, ssl.SSLError, ValueError):
+        return None
+    finally:
+        if connection:
+            connection.close()
+    # Older members report the health as a string.
+    if health not in (True, 'true'):
+        return None
+    return time.time() - start
+
+
+def order_endpoints(endpoints, previous=None, timeout=2, ca=None, key=None,
+                    cert=None):
+    '''Probe the endpoints at the same time and return the endpoints with the
+    healthy members first, fastest first, followed by the unhealthy members,
+    and the list of healthy members. When the same members are healthy as in
+    the previous result the previous order is kept, so small changes in the
+    latency do not change the order and restart the apiserver.'''
+    if not endpoints:
+        return [], []
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        latencies = list(executor.map(
+            lambda endpoint: probe(endpoint, timeout, ca, key, cert),
+            endpoints))
+    healthy = [endpoint for latency, index, endpoint in
+               sorted((latency, index, endpoint) for index, (endpoint, latency)
+                      in enumerate(zip(endpoints, latencies))
+                      if latency is not None)]
+    if previous:
+        order, was_healthy = previous
+        if sorted(order) == sorted(endpoints) and \
+                sorted(was_healthy) == sorted(healthy):
+            return list(order), healthy
+    order = healthy + [endpoint for endpoint in endpoints
+                       if endpoint not in healthy]
+    return order, healthy
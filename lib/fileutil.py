@@ -0,0 +1,63 @@
+import grp
+import hashlib
+import os
+import pwd
+import tempfile
+
+
+def atomic_write(path, content, owner=None, group=None, perms=0o644):
+    '''Write the content to the path by renaming a temporary file over the
+    destination, return True if the file changed and False when the existing
+    file already had the same content, owner and permissions. '''
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    uid = pwd.getpwnam(owner).pw_uid if owner else -1
+    gid = grp.getgrnam(group or owner).gr_gid if (group or owner) else -1
+    if _unchanged(path, content, uid, gid, perms):
+        return False
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # The temporary file must be on the same filesystem for rename to work.
+    fd, temp = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(path)),
+                                dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(content)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.chmod(temp, perms)
+        if uid != -1 or gid != -1:
+            os.chown(temp, uid, gid)
+        os.rename(temp, path)
+    except Exception:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return True
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    '''Return the hex SHA-256 digest of the file at path, reading the file in
+    chunks so large binaries are not loaded in to memory. '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _unchanged(path, content, uid, gid, perms):
+    '''Return True if the file at path matches the content and metadata.'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != len(content) or (stat.st_mode & 0o777) != perms:
+        return False
+    if uid != -1 and stat.st_uid != uid:
+        return False
+    if gid != -1 and stat.st_gid != gid:
+        return False
+    with open(path, 'rb') as stream:
+        return stream.read() == content
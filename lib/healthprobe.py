@@ -0,0 +1,140 @@
+import random
+import socket
+import ssl
+import struct
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPSConnection
+
+# The DNS record type and class of an IPv4 address query.
+DNS_TYPE_A = 1
+DNS_CLASS_IN = 1
+# The names of the DNS response codes reported in the errors.
+DNS_RCODES = {1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 5: 'REFUSED'}
+
+
+class ProbeError(Exception):
+    '''Raised by a probe when the component answered but is not healthy. '''
+    pass
+
+
+def http_probe(host, port, path='/healthz', timeout=2, tls=False, ca=None,
+               key=None, cert=None):
+    '''Return a probe function that expects a 200 response to a GET of the
+    path. With tls the connection is verified with the ca, or not verified
+    at all when there is no ca, and the key and cert are sent to the
+    server.'''
+    def probe():
+        if tls:
+            if ca:
+                context = ssl.create_default_context(cafile=ca)
+                # The local components are reached by address, not by name.
+                context.check_hostname = False
+            else:
+                # A context that does not verify or load the system CAs.
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            if key and cert:
+                context.load_cert_chain(cert, key)
+            connection = HTTPSConnection(host, port, timeout=timeout,
+                                         context=context)
+        else:
+            connection = HTTPConnection(host, port, timeout=timeout)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ProbeError('{0} {1}'.format(response.status,
+                                              response.reason))
+    return probe
+
+
+def dns_query(name, query_id):
+    '''Return a DNS query packet that asks for the A records of the name.'''
+    # The header asks for recursion and holds one question.
+    packet = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    for label in name.rstrip('.').split('.'):
+        encoded = label.encode('idna')
+        packet += struct.pack('>B', len(encoded)) + encoded
+    return packet + struct.pack('>BHH', 0, DNS_TYPE_A, DNS_CLASS_IN)
+
+
+def dns_answers(response, query_id):
+    '''Return the number of answers in the DNS response, or None when the
+    response is not an answer to the query id. Raise ProbeError when the
+    server could not answer the query.'''
+    if len(response) < 12:
+        return None
+    response_id, flags, questions, answers = struct.unpack('>HHHH',
+                                                           response[:8])
+    if response_id != query_id or not flags & 0x8000:
+        return None
+    rcode = flags & 0x000f
+    if rcode:
+        raise ProbeError(DNS_RCODES.get(rcode, 'rcode {0}'.format(rcode)))
+    return answers
+
+
+def dns_probe(server, name, port=53, timeout=2):
+    '''Return a probe function that resolves the name with the DNS server
+    and expects at least one address.'''
+    def probe():
+        query_id = random.randint(0, 0xffff)
+        connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            connection.sendto(dns_query(name, query_id), (server, port))
+            deadline = time.time() + timeout
+            answers = None
+            # Skip stray packets until the answer arrives or time runs out.
+            while answers is None:
+                connection.settimeout(max(deadline - time.time(), 0.01))
+                response, address = connection.recvfrom(512)
+                answers = dns_answers(response, query_id)
+        finally:
+            connection.close()
+        if not answers:
+            raise ProbeError('no address for {0}'.format(name))
+    return probe
+
+
+def run_probe(probe):
+    '''Run the probe and return a dictionary of the result.'''
+    start = time.time()
+    try:
+        probe()
+        error = None
+    except socket.timeout:
+        error = 'timed out'
+    except (ProbeError, HTTPException, socket.error, ssl.SSLError) as e:
+        error = str(e) or e.__class__.__name__
+    return {'healthy': error is None, 'seconds': time.time() - start,
+            'error': error}
+
+
+def run_probes(probes, budget):
+    '''Run the probes in a dictionary of names and probe functions at the
+    same time and return a dictionary of the names and results. The probes
+    that have not finished when the budget in seconds runs out are reported
+    as unhealthy and left to finish in the background.'''
+    if not probes:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=len(probes))
+    futures = {executor.submit(run_probe, probe): name
+               for name, probe in probes.items()}
+    done, _ = wait(futures, timeout=budget)
+    executor.shutdown(wait=False)
+    results = {}
+    for future, name in futures.items():
+        if future in done:
+            results[name] = future.result()
+        else:
+            results[name] = {'healthy': False, 'seconds': budget,
+                             'error': 'exceeded the {0} second budget'.format(
+                                 budget)}
+    return results
@@ -0,0 +1,79 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from subprocess import CalledProcessError
+from subprocess import check_call
+from subprocess import DEVNULL
+
+
+def compose_images(compose, services):
+    '''Return the images used by the named services of a parsed
+    docker-compose file.'''
+    images = []
+    for service in services:
+        definition = compose.get(service) or {}
+        if definition.get('image'):
+            images.append(definition['image'])
+    return images
+
+
+def pod_images(manifest):
+    '''Return the container images in a parsed Pod or ReplicationController
+    manifest.'''
+    spec = manifest.get('spec') or {}
+    # Controllers keep the pod specification in a template.
+    if 'template' in spec:
+        spec = spec['template'].get('spec') or {}
+    return [container['image'] for container in spec.get('containers', [])
+            if container.get('image')]
+
+
+def pull_images(images, workers=4, progress=None, mirrors=None):
+    '''Pull the images with docker using a pool of workers. The progress
+    callback is called with the number of finished pulls, the total and the
+    image after each pull. The mirrors map a registry to a cache that is
+    tried first, the image is pulled from its own registry when the cache
+    fails. Return the seconds each pull took, raise CalledProcessError after
+    all pulls finish if any of them failed.'''
+    # Keep the order but pull each image only once.
+    images = [image for index, image in enumerate(images)
+              if image not in images[:index]]
+    durations = {}
+    failed = []
+    if not images:
+        return durations
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(_pull, image, mirrors or {}): image
+                   for image in images}
+        for done, future in enumerate(as_completed(futures), 1):
+            image = futures[future]
+            try:
+                durations[image] = future.result()
+            except CalledProcessError:
+                failed.append(image)
+            if progress:
+                progress(done, len(images), image)
+    if failed:
+        raise CalledProcessError(1, ['docker', 'pull'] + failed)
+    return durations
+
+
+def _pull(image, mirrors):
+    '''Pull one image, through the mirror of its registry when there is one,
+    and return how many seconds it took.'''
+    start = time.time()
+    registry, _, name = image.partition('/')
+    mirror = mirrors.get(registry) if name else None
+    if mirror:
+        cached = '{0}/{1}'.format(mirror, name)
+        try:
+            check_call(['docker', 'pull', cached], stdout=DEVNULL)
+            # The services and pods use the name from the original registry.
+            check_call(['docker', 'tag', cached, image], stdout=DEVNULL)
+            return time.time() - start
+        except CalledProcessError:
+            # Fall back to the original registry.
+            pass
+    check_call(['docker', 'pull', image], stdout=DEVNULL)
+    return time.time() - start
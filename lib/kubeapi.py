@@ -0,0 +1,302 @@
+import copy
+import json
+import socket
+import ssl
+import time
+
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPSConnection
+from urllib.parse import quote
+from urllib.parse import urlparse
+
+import yaml
+
+# The path segment and namespace scope for the kinds this charm manages.
+RESOURCES = {
+    'Namespace': ('namespaces', False),
+    'Node': ('nodes', False),
+    'Pod': ('pods', True),
+    'ReplicationController': ('replicationcontrollers', True),
+    'Service': ('services', True),
+}
+
+
+class KubeAPIError(Exception):
+    '''Raised when the apiserver returns an unexpected response. '''
+    def __init__(self, status, reason, method, path):
+        message = '{0} {1} returned {2} {3}'.format(method, path, status,
+                                                     reason)
+        super(KubeAPIError, self).__init__(message)
+        self.status = status
+
+
+class KubeClient(object):
+    '''A small client for the Kubernetes apiserver REST API that keeps one
+    HTTP connection open for all of its requests. '''
+
+    def __init__(self, server='http://127.0.0.1:8080', timeout=10, ca=None,
+                 key=None, cert=None):
+        '''Create a client for the apiserver at the server url, when the url
+        is https the ca, key and cert files are used for the connection.'''
+        url = urlparse(server)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.timeout = timeout
+        self.context = None
+        if self.scheme == 'https':
+            self.context = ssl.create_default_context(cafile=ca)
+            if cert and key:
+                self.context.load_cert_chain(cert, key)
+        self.connection = None
+
+    def close(self):
+        '''Close the connection to the apiserver.'''
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, method, path, body=None,
+                content_type='application/json'):
+        '''Send a request to the apiserver and return the status and decoded
+        JSON body of the response. A dropped keep-alive connection is opened
+        again once before the error is raised. '''
+        headers = {'Accept': 'application/json'}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = content_type
+        for attempt in range(2):
+            connection = self._connect()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (HTTPException, socket.error):
+                self.close()
+                if attempt:
+                    raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        if data:
+            try:
+                data = json.loads(data.decode('utf-8'))
+            except ValueError:
+                data = data.decode('utf-8', 'replace')
+        return response.status, response.reason, data
+
+    def get(self, path):
+        '''Return the object at the path or None when it does not exist.'''
+        status, reason, data = self.request('GET', path)
+        if status == 404:
+            return None
+        if status >= 300:
+            raise KubeAPIError(status, reason, 'GET', path)
+        return data
+
+    def create(self, path, body):
+        '''Create the object in the collection at the path.'''
+        return self._checked('POST', path, body)
+
+    def patch(self, path, body):
+        '''Apply a merge patch to the object at the path.'''
+        return self._checked('PATCH', path, body,
+                             'application/merge-patch+json')
+
+    def delete(self, path):
+        '''Delete the object at the path, return False if it was not found.'''
+        status, reason, data = self.request('DELETE', path)
+        if status == 404:
+            return False
+        if status >= 300:
+            raise KubeAPIError(status, reason, 'DELETE', path)
+        return True
+
+    def healthy(self):
+        '''Return True when the apiserver answers the health check.'''
+        try:
+            status, reason, data = self.request('GET', '/healthz')
+        except (HTTPException, socket.error):
+            return False
+        return status == 200
+
+    def wait_ready(self, timeout=300, initial=1, maximum=30):
+        '''Wait for the apiserver to become healthy, sleeping with a doubling
+        delay between checks, return False if it is not ready in time.'''
+        deadline = time.time() + timeout
+        delay = initial
+        while not self.healthy():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, maximum)
+        return True
+
+    def pods(self, namespace, selector):
+        '''Return the pods in the namespace that match the label selector.'''
+        path = '/api/v1/namespaces/{0}/pods?labelSelector={1}'.format(
+            namespace, quote(selector))
+        return (self.get(path) or {}).get('items') or []
+
+    def delete_pods(self, namespace, selector):
+        '''Delete the pods in the namespace that match the label selector and
+        return the names of the pods that were deleted.'''
+        deleted = []
+        for pod in self.pods(namespace, selector):
+            name = pod['metadata']['name']
+            if self.delete('/api/v1/namespaces/{0}/pods/{1}'.format(
+                    namespace, name)):
+                deleted.append(name)
+        return deleted
+
+    def scale_down(self, path, timeout=120, interval=1):
+        '''Scale the replication controller at the path to zero replicas and
+        wait for its pods to stop, because deleting a controller through the
+        REST API does not delete its pods. Return False when the controller
+        still has pods after the timeout.'''
+        self.patch(path, {'spec': {'replicas': 0}})
+
+        def stopped():
+            controller = self.get(path)
+            return not controller or \
+                not (controller.get('status') or {}).get('replicas')
+        return poll(stopped, timeout, interval)
+
+    def restart_pods(self, path, timeout=300, interval=1):
+        '''Delete the pods of the replication controller at the path one at a
+        time so the controller creates them again from its current template,
+        because replacing the template does not change the running pods. The
+        next pod is only deleted when as many pods are ready as before the
+        restart. Return the names of the pods that were not restarted because
+        the new pods were not ready before the timeout.'''
+        controller = self.get(path)
+        if not controller:
+            return []
+        namespace = controller['metadata'].get('namespace', 'default')
+        selector = ','.join('{0}={1}'.format(key, value) for key, value in
+                            sorted(controller['spec']['selector'].items()))
+        pods = self.pods(namespace, selector)
+        names = [pod['metadata']['name'] for pod in pods]
+        required = min(len([pod for pod in pods if pod_ready(pod)]),
+                       controller['spec'].get('replicas', 1))
+
+        def ready():
+            # The deleted pods are still listed until they have stopped.
+            return len([pod for pod in self.pods(namespace, selector)
+                        if pod_ready(pod) and
+                        not pod['metadata'].get('deletionTimestamp')]) >= \
+                required
+        deadline = time.time() + timeout
+        for index, name in enumerate(names):
+            self.delete('/api/v1/namespaces/{0}/pods/{1}'.format(namespace,
+                                                                 name))
+            if not poll(ready, deadline - time.time(), interval):
+                return names[index + 1:]
+        return []
+
+    def replace(self, path, body):
+        '''Replace the object at the path with the body.'''
+        return self._checked('PUT', path, body)
+
+    def apply(self, manifests, replace=False):
+        '''Create each object in the manifests that does not already exist,
+        in order, over the same connection. When replace is True existing
+        objects are updated to match the manifest, a service that can not be
+        updated is deleted and created again. Return the list of object paths
+        that were created or replaced. '''
+        applied = []
+        for manifest in manifests:
+            path = object_path(manifest)
+            existing = self.get(path)
+            if existing is None:
+                try:
+                    self.create(collection_path(manifest), manifest)
+                    applied.append(path)
+                    continue
+                except KubeAPIError as error:
+                    if error.status != 409:
+                        raise
+                # Another client created the object after the get, handle it
+                # as an existing object.
+                existing = self.get(path)
+            if replace and existing is not None:
+                body = copy.deepcopy(manifest)
+                # The apiserver rejects updates without the current version.
+                version = existing['metadata'].get('resourceVersion')
+                body['metadata']['resourceVersion'] = version
+                try:
+                    self.replace(path, body)
+                except KubeAPIError as error:
+                    if error.status != 422 or manifest['kind'] != 'Service':
+                        raise
+                    # The clusterIP of a service can not be changed, create
+                    # the service again with the new address.
+                    self.delete(path)
+                    self.create(collection_path(manifest), manifest)
+                applied.append(path)
+        return applied
+
+    def _checked(self, method, path, body, content_type='application/json'):
+        '''Send the request and raise an error for an unsuccessful status.'''
+        status, reason, data = self.request(method, path, body, content_type)
+        if status >= 300:
+            raise KubeAPIError(status, reason, method, path)
+        return data
+
+    def _connect(self):
+        '''Return the open connection, creating it if necessary.'''
+        if self.connection is None:
+            if self.scheme == 'https':
+                self.connection = HTTPSConnection(self.host, self.port,
+                                                  timeout=self.timeout,
+                                                  context=self.context)
+            else:
+                self.connection = HTTPConnection(self.host, self.port,
+                                                 timeout=self.timeout)
+        return self.connection
+
+
+def poll(check, timeout, interval=1):
+    '''Call check until it returns True, return False when it did not
+    return True before the timeout in seconds.'''
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def pod_ready(pod):
+    '''Return True when the Ready condition of the pod is True.'''
+    for condition in (pod.get('status') or {}).get('conditions') or []:
+        if condition['type'] == 'Ready':
+            return condition['status'] == 'True'
+    return False
+
+
+def collection_path(manifest):
+    '''Return the REST path of the collection the manifest object belongs to.
+    '''
+    plural, namespaced = RESOURCES[manifest['kind']]
+    if namespaced:
+        namespace = manifest['metadata'].get('namespace', 'default')
+        return '/api/v1/namespaces/{0}/{1}'.format(namespace, plural)
+    return '/api/v1/{0}'.format(plural)
+
+
+def object_path(manifest):
+    '''Return the REST path of the object described by the manifest.'''
+    return '{0}/{1}'.format(collection_path(manifest),
+                            manifest['metadata']['name'])
+
+
+def load_manifests(*paths):
+    '''Return a list of every object in the YAML or JSON manifest files.'''
+    manifests = []
+    for path in paths:
+        with open(path) as stream:
+            manifests.extend(m for m in yaml.safe_load_all(stream) if m)
+    return manifests
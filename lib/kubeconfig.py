@@ -0,0 +1,51 @@
+import base64
+
+import yaml
+
+from fileutil import atomic_write
+
+
+def build_kubeconfig(server, ca, key, cert, user='ubuntu',
+                     cluster='kubernetes', context='default-context',
+                     embed=False):
+    '''Return the kubeconfig as a dictionary with one cluster, user and
+    context, the same structure the "kubectl config" commands create. When
+    embed is True the certificate files are included inline as base64 data so
+    the kubeconfig can be used without the other files. '''
+    cluster_data = {'server': server}
+    user_data = {}
+    if embed:
+        cluster_data['certificate-authority-data'] = _encode(ca)
+        user_data['client-certificate-data'] = _encode(cert)
+        user_data['client-key-data'] = _encode(key)
+    else:
+        cluster_data['certificate-authority'] = ca
+        user_data['client-certificate'] = cert
+        user_data['client-key'] = key
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'preferences': {},
+        'clusters': [{'name': cluster, 'cluster': cluster_data}],
+        'users': [{'name': user, 'user': user_data}],
+        'contexts': [{'name': context,
+                      'context': {'cluster': cluster, 'user': user}}],
+        'current-context': context,
+    }
+
+
+def write_kubeconfig(path, server, ca, key, cert, user='ubuntu', embed=False,
+                     owner=None, group=None):
+    '''Render the kubeconfig and write it to path in one atomic operation.
+    Return True when the file was written and False when the content on disk
+    was already the same. '''
+    config = build_kubeconfig(server, ca, key, cert, user=user, embed=embed)
+    content = yaml.safe_dump(config, default_flow_style=False)
+    # The kubeconfig can contain a private key so only the owner can read it.
+    return atomic_write(path, content, owner=owner, group=group, perms=0o600)
+
+
+def _encode(path):
+    '''Return the base64 encoded contents of the file at path as a string.'''
+    with open(path, 'rb') as stream:
+        return base64.b64encode(stream.read()).decode('ascii')
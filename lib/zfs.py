@@ -0,0 +1,104 @@
+import os
+import shutil
+
+from subprocess import CalledProcessError
+from subprocess import check_output
+
+# The kernel module parameters and the modprobe file for the ARC limit.
+ZFS_PARAMETERS = '/sys/module/zfs/parameters'
+MODPROBE_CONF = '/etc/modprobe.d/zfs-arc.conf'
+
+
+def zfs(*args):
+    '''Run the zfs command with the arguments and return the output.'''
+    return check_output(['zfs'] + list(args)).decode('utf-8')
+
+
+def dataset_of(path):
+    '''Return the name of the ZFS dataset that holds the path, or None when
+    the path is not on ZFS or ZFS is not installed.'''
+    try:
+        output = zfs('list', '-H', '-o', 'name', path)
+    except (CalledProcessError, OSError):
+        return None
+    names = output.split()
+    return names[0] if names else None
+
+
+def dataset_exists(name):
+    '''Return True when the dataset exists.'''
+    try:
+        zfs('list', '-H', '-o', 'name', name)
+    except CalledProcessError:
+        return False
+    return True
+
+
+def get_properties(dataset, names):
+    '''Return a dictionary of the values of the named properties.'''
+    output = zfs('get', '-H', '-o', 'property,value', ','.join(names),
+                 dataset)
+    properties = {}
+    for line in output.splitlines():
+        name, value = line.split('\t', 1)
+        properties[name] = value
+    return properties
+
+
+def set_properties(dataset, properties):
+    '''Set the properties of the dataset that have a different value and
+    return the names of the properties that were changed.'''
+    current = get_properties(dataset, sorted(properties))
+    changed = []
+    for name, value in sorted(properties.items()):
+        if current.get(name) != value:
+            # Older releases only accept one property for each zfs set.
+            zfs('set', '{0}={1}'.format(name, value), dataset)
+            changed.append(name)
+    return changed
+
+
+def create_dataset(name, mountpoint, properties):
+    '''Create the dataset mounted at the mountpoint with the properties. The
+    files that are already in the mountpoint are moved to a directory next
+    to it first, the path of that directory is returned or None when the
+    mountpoint was empty.'''
+    moved = None
+    if os.path.isdir(mountpoint) and os.listdir(mountpoint):
+        # ZFS does not mount a dataset on a directory that is not empty.
+        moved = '{0}.pre-zfs'.format(mountpoint.rstrip('/'))
+        os.rename(mountpoint, moved)
+    options = ['-o', 'mountpoint={0}'.format(mountpoint)]
+    for key, value in sorted(properties.items()):
+        options.extend(['-o', '{0}={1}'.format(key, value)])
+    zfs('create', *(options + [name]))
+    return moved
+
+
+def restore_files(source, target):
+    '''Move the files in the source directory to the target directory and
+    remove the source directory.'''
+    for name in os.listdir(source):
+        shutil.move(os.path.join(source, name), os.path.join(target, name))
+    os.rmdir(source)
+
+
+def set_arc_max(size, parameters=ZFS_PARAMETERS, modprobe=MODPROBE_CONF):
+    '''Limit the ARC to size bytes now and when the module is loaded again,
+    a size of zero restores the default limit. Return True when the running
+    limit was changed.'''
+    if size:
+        content = 'options zfs zfs_arc_max={0}\n'.format(size)
+        with open(modprobe, 'w') as stream:
+            stream.write(content)
+    elif os.path.exists(modprobe):
+        os.remove(modprobe)
+    parameter = os.path.join(parameters, 'zfs_arc_max')
+    if not os.path.exists(parameter):
+        return False
+    with open(parameter) as stream:
+        if stream.read().strip() == str(size):
+            return False
+    with open(parameter, 'w') as stream:
+        stream.write(str(size))
+    return True
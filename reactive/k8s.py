@@ -1,16 +1,30 @@
+import binascii
+import hashlib
+import json
+import math
+import multiprocessing
 import os
+import pwd
+import re
+import socket
+import time
 
-from shlex import split
-from subprocess import call
+from http.client import HTTPConnection
+from http.client import HTTPException
 from subprocess import check_call
 from subprocess import check_output
+from subprocess import DEVNULL
 
+import yaml
+
+from charms.docker import DockerOpts
 from charms.docker.compose import Compose
 from charms.reactive import hook
+from charms.reactive import is_state
+from charms.reactive import RelationBase
 from charms.reactive import remove_state
 from charms.reactive import set_state
 from charms.reactive import when
-from charms.reactive import when_any
 from charms.reactive import when_not
 
 from charmhelpers.core import hookenv
@@ -19,15 +33,164 @@ from charmhelpers.core.hookenv import leader_set
 from charmhelpers.core.hookenv import leader_get
 from charmhelpers.core.templating import render
 from charmhelpers.core import unitdata
-from charmhelpers.core.host import chdir
 
 import tlslib
 
+from archive import members_digest
+from archive import write_tarball
+from artifacts import ArtifactCache
+from artifacts import ArtifactError
+from artifacts import ChecksumError
+from artifacts import install as install_artifact
+from cadvisor import parse_timestamp
+from etcdhealth import order_endpoints
+from etcdhealth import split_endpoints
+from fileutil import atomic_write
+from healthprobe import dns_probe
+from healthprobe import http_probe
+from healthprobe import run_probes
+from images import compose_images
+from images import pod_images
+from images import pull_images
+from kubeapi import KubeAPIError
+from kubeapi import KubeClient
+from kubeapi import load_manifests
+from kubeapi import object_path
+from kubeapi import poll
+from kubeconfig import write_kubeconfig
+
+import zfs
+
+# The storage mount point from layer.yaml that holds the certificates.
+KUBERNETES_DIR = '/srv/kubernetes'
+# The directory for the kubelet data and the node kubeconfig.
+KUBELET_DIR = '/var/lib/kubelet'
+# The directory for the docker images and containers.
+DOCKER_DIR = '/var/lib/docker'
+# The path where the kubectl binary is installed.
+KUBECTL = '/usr/local/bin/kubectl'
+# The insecure apiserver address, the apiserver runs on the leader unit.
+APISERVER = 'http://127.0.0.1:8080'
+# The pull-through registry caches for Docker Hub and gcr.io, the leader
+# starts them and they stay on that unit when the leadership changes.
+REGISTRY_SERVICES = ['registry', 'registry-gcr']
+# The seconds to wait for each etcd member to answer the health check.
+ETCD_PROBE_TIMEOUT = 2
+# The port the cluster DNS service answers queries on.
+DNS_PORT = 53
+# The leader settings that share the basic auth and token files of the
+# apiservers with the masters, and the names of the files.
+AUTH_FILES = {
+    'basic-auth': 'basic_auth.csv',
+    'known-tokens': 'known_tokens.csv',
+}
+# The official haproxy image for each architecture, the images of the other
+# architectures are published in their own namespace.
+HAPROXY_IMAGES = {
+    'amd64': 'haproxy:1.6',
+    'arm': 'armhf/haproxy:1.6',
+    'arm64': 'aarch64/haproxy:1.6',
+    'ppc64le': 'ppc64le/haproxy:1.6',
+}
+# The seconds a restarted node waits in the hook for its kubelet to report
+# Ready, the kubelets post the node status every 10 seconds.
+NODE_READY_WAIT = 60
+# The smallest value allowed for the integer configuration options.
+MINIMUM_VALUES = {
+    'apiserver_log_level': 0,
+    'apiserver_max_requests_inflight': 0,
+    'controller_manager_kube_api_burst': 1,
+    'controller_manager_kube_api_qps': 1,
+    'dns_cache_size': 0,
+    'dns_cores_per_replica': 1,
+    'dns_max_replicas': 1,
+    'dns_min_replicas': 1,
+    'dns_nodes_per_replica': 1,
+    'health_probe_timeout': 1,
+    'image_gc_high_threshold': 0,
+    'image_gc_low_threshold': 0,
+    'kubectl_package_compression': 0,
+    'kubelet_log_level': 0,
+    'kubelet_max_pods': 1,
+    'master_count': 1,
+    'proxy_conntrack_max': 0,
+    'proxy_log_level': 0,
+    'registry_cache_port': 1,
+    'restart_batch_size': 1,
+    'restart_ready_timeout': 0,
+    'zfs_arc_max': 0,
+    'scheduler_kube_api_burst': 1,
+    'scheduler_kube_api_qps': 1,
+}
+# The largest value allowed for the integer configuration options.
+MAXIMUM_VALUES = {
+    'apiserver_log_level': 10,
+    'image_gc_high_threshold': 100,
+    'image_gc_low_threshold': 100,
+    'kubectl_package_compression': 9,
+    'kubelet_log_level': 10,
+    'proxy_log_level': 10,
+    # The gcr.io cache listens on the port after the Docker Hub cache.
+    'registry_cache_port': 65534,
+}
+# Options that must not be lower than the value of another option.
+LOWER_BOUNDS = {
+    'controller_manager_kube_api_burst': 'controller_manager_kube_api_qps',
+    'dns_max_replicas': 'dns_min_replicas',
+    'image_gc_high_threshold': 'image_gc_low_threshold',
+    'scheduler_kube_api_burst': 'scheduler_kube_api_qps',
+}
+# The options that must be Kubernetes CPU or memory quantities.
+QUANTITY_OPTIONS = ['kubedns_cpu_limit', 'kubedns_cpu_request',
+                    'kubedns_memory_limit', 'kubedns_memory_request']
+# The options that must be durations.
+DURATION_OPTIONS = ['min_resync_period',
+                    'proxy_conntrack_tcp_timeout_established']
+# The compression algorithms of ZFS.
+ZFS_COMPRESSION = ['off', 'on', 'lz4', 'lzjb', 'zle', 'gzip'] + \
+    ['gzip-{0}'.format(level) for level in range(1, 10)]
+# The options that only accept a few values.
+CHOICES = {
+    'proxy_mode': ['iptables', 'userspace'],
+    'zfs_docker_compression': ZFS_COMPRESSION,
+    'zfs_kubelet_compression': ZFS_COMPRESSION,
+    'zfs_kubernetes_compression': ZFS_COMPRESSION,
+}
+# The ZFS datasets the charm tunes, by configuration option prefix.
+ZFS_DATASETS = ['docker', 'kubelet', 'kubernetes']
+# A ZFS record size, a power of two from 512 bytes to 1M.
+RECORDSIZE = re.compile(r'^(512|1K|2K|4K|8K|16K|32K|64K|128K|256K|512K|1M)$')
+# A Kubernetes resource quantity such as "100m" or "200Mi".
+QUANTITY = re.compile(r'^\d+(\.\d+)?(m|k|M|G|T|Ki|Mi|Gi|Ti)?$')
+# A Go duration such as "90s" or "1h30m".
+DURATION = re.compile(r'^(\d+(\.\d+)?(ns|us|ms|s|m|h))+$')
+# A comma separated list of "resource#size" watch cache sizes.
+WATCH_CACHE_SIZES = re.compile(r'^[a-z]+#\d+(,[a-z]+#\d+)*$')
+
 
 @when('leadership.is_leader')
 def i_am_leader():
-    '''The leader is the Kubernetes master node. '''
-    leader_set({'master-address': hookenv.unit_private_ip()})
+    '''The leader is always a Kubernetes master, it selects the other masters
+    from the peers and shares their unit names and addresses.'''
+    count = hookenv.config().get('master_count')
+    masters, addresses = select_masters(count)
+    settings = {'master-address': hookenv.unit_private_ip(),
+                'masters': ','.join(masters),
+                'master-addresses': ','.join(addresses)}
+    current = leader_get()
+    started = unitdata.kv().get('k8s.fingerprints') is not None
+    if not current.get('service-account-key') and (count > 1 or not started):
+        # The masters sign and verify the service account tokens with a
+        # dedicated key that is kept when the leadership changes. A single
+        # master that already signed tokens with its server key keeps it.
+        settings['service-account-key'] = generate_service_account_key()
+    for key in AUTH_FILES:
+        if not current.get(key):
+            # The apiservers behind the load balancer must accept the same
+            # passwords and tokens.
+            settings[key] = auth_file(key)
+    if any(current.get(key) != value for key, value in settings.items()):
+        leader_set(settings)
 
 
 @when_not('tls.client.authorization.required')
@@ -37,51 +200,21 @@ def configure_easrsa():
     # Setting this state before easyrsa is configured ensures the tls layer is
     # configured to generate certificates with client authentication.
     set_state('tls.client.authorization.required')
-    domain = hookenv.config().get('dns_domain')
-    cidr = hookenv.config().get('cidr')
-    sdn_ip = get_sdn_ip(cidr)
-    # Create extra sans that the tls layer will add to the server cert.
-    extra_sans = [
-        sdn_ip,
-        'kubernetes',
-        'kubernetes.{0}'.format(domain),
-        'kubernetes.default',
-        'kubernetes.default.svc',
-        'kubernetes.default.svc.{0}'.format(domain)
-    ]
-    unitdata.kv().set('extra_sans', extra_sans)
+    unitdata.kv().set('extra_sans', extra_sans())
 
 
 @hook('config-changed')
 def config_changed():
-    '''If the configuration values change, remove the available states.'''
+    '''If the configuration values change, remove the available states so
+    the files are rendered again and the changed services are restarted.'''
     config = hookenv.config()
     if any(config.changed(key) for key in config.keys()):
         hookenv.log('The configuration options have changed.')
-        # Use the Compose class that encapsulates the docker-compose commands.
-        compose = Compose('files/kubernetes')
-        if is_leader():
-            hookenv.log('Removing master container and kubelet.available state.')  # noqa
-            # Stop and remove the Kubernetes kubelet container.
-            compose.kill('master')
-            compose.rm('master')
-            compose.kill('proxy')
-            compose.rm('proxy')
-            # Remove the state so the code can react to restarting kubelet.
-            remove_state('kubelet.available')
-        else:
-            hookenv.log('Removing kubelet container and kubelet.available state.')  # noqa
-            # Stop and remove the Kubernetes kubelet container.
-            compose.kill('kubelet')
-            compose.rm('kubelet')
-            # Remove the state so the code can react to restarting kubelet.
-            remove_state('kubelet.available')
-            hookenv.log('Removing proxy container and proxy.available state.')
-            # Stop and remove the Kubernetes proxy container.
-            compose.kill('proxy')
-            compose.rm('proxy')
-            # Remove the state so the code can react to restarting proxy.
-            remove_state('proxy.available')
+        # The containers are left running, start_kubelet compares the
+        # rendered files and only restarts the services that changed.
+        hookenv.log('Removing kubelet.available and proxy.available states.')
+        remove_state('kubelet.available')
+        remove_state('proxy.available')
 
     if config.changed('version'):
         hookenv.log('The version changed removing the states so the new '
@@ -89,14 +222,31 @@ def config_changed():
         remove_state('kubectl.downloaded')
         remove_state('kubeconfig.created')
 
+    if config.changed('kubectl_source') or config.changed('kubectl_sha256'):
+        hookenv.log('The kubectl source changed, removing the state so '
+                    'kubectl is installed again.')
+        remove_state('kubectl.downloaded')
+
+    if any(config.changed(key) for key in config.keys()
+           if key.startswith('zfs_')):
+        hookenv.log('The ZFS options changed, removing the state so the '
+                    'datasets are tuned again.')
+        remove_state('zfs.configured')
+
+    if config.changed('embed_certificates') or \
+            config.changed('kubectl_package_compression'):
+        hookenv.log('The kubeconfig options changed, removing the state so '
+                    'the kubeconfig files and package are written again.')
+        remove_state('kubeconfig.created')
+
 
 @when('tls.server.certificate available')
 @when_not('k8s.server.certificate available')
 def server_cert():
     '''When the server certificate is available, get the server certificate
     from the charm unitdata and write it to the kubernetes directory. '''
-    server_cert = '/srv/kubernetes/server.crt'
-    server_key = '/srv/kubernetes/server.key'
+    server_cert = os.path.join(KUBERNETES_DIR, 'server.crt')
+    server_key = os.path.join(KUBERNETES_DIR, 'server.key')
     # Save the server certificate from unit data to the destination.
     tlslib.server_cert(None, server_cert, user='ubuntu', group='ubuntu')
     # Copy the server key from the default location to the destination.
@@ -109,8 +259,8 @@ def server_cert():
 def client_cert():
     '''When the client certificate is available, get the client certificate
     from the charm unitdata and write it to the kubernetes directory. '''
-    client_cert = '/srv/kubernetes/client.crt'
-    client_key = '/srv/kubernetes/client.key'
+    client_cert = os.path.join(KUBERNETES_DIR, 'client.crt')
+    client_key = os.path.join(KUBERNETES_DIR, 'client.key')
     # Save the client certificate from the default location to the destination.
     tlslib.client_cert(None, client_cert, user='ubuntu', group='ubuntu')
     # Copy the client key from the default location to the destination.
@@ -123,7 +273,7 @@ def client_cert():
 def ca():
     '''When the Certificate Authority is available, copy the CA from the
     default location to the /srv/kubernetes directory. '''
-    ca_crt = '/srv/kubernetes/ca.crt'
+    ca_crt = os.path.join(KUBERNETES_DIR, 'ca.crt')
     # Copy the Certificate Authority to the destination directory.
     tlslib.ca(None, ca_crt, user='ubuntu', group='ubuntu')
     set_state('k8s.certificate.authority available')
@@ -137,42 +287,393 @@ def launch_dns():
     hookenv.log('Creating kubernetes kubedns on the master node.')
     # Only launch and track this state on the leader.
     # Launching duplicate kubeDNS rc will raise an error
-    # Run a command to check if the apiserver is responding.
-    return_code = call(split('kubectl cluster-info'))
-    if return_code != 0:
-        hookenv.log('kubectl command failed, waiting for apiserver to start.')
-        remove_state('kubedns.available')
-        # Return without setting kubedns.available so this method will retry.
+    client = KubeClient(APISERVER)
+    try:
+        # Wait in this hook for the apiserver rather than the next hook.
+        if not client.wait_ready(timeout=300):
+            hookenv.log('The apiserver did not respond, will retry kubedns.')
+            remove_state('kubedns.available')
+            # Return without setting kubedns.available so this will retry.
+            return
+        apply_kubedns(client)
+    except (HTTPException, KubeAPIError, socket.error) as error:
+        hookenv.log('Failed to launch kubedns, will retry: {0}'.format(error))
         return
-    # Check for the "kube-system" namespace.
-    return_code = call(split('kubectl get namespace kube-system'))
-    if return_code != 0:
-        # Create the kube-system namespace that is used by the kubedns files.
-        check_call(split('kubectl create namespace kube-system'))
-    # Check for the kubedns replication controller.
-    return_code = call(split('kubectl get -f files/manifests/kubedns-rc.yaml'))
-    if return_code != 0:
-        # Create the kubedns replication controller from the rendered file.
-        check_call(split('kubectl create -f files/manifests/kubedns-rc.yaml'))
-    # Check for the kubedns service.
-    return_code = call(split('kubectl get -f files/manifests/kubedns-svc.yaml'))
-    if return_code != 0:
-        # Create the kubedns service from the rendered file.
-        check_call(split('kubectl create -f files/manifests/kubedns-svc.yaml'))
+    finally:
+        client.close()
+    remove_state('kubedns.changed')
     set_state('kubedns.available')
 
 
+def apply_kubedns(client):
+    '''Create or update the kube-system namespace and the kubedns objects
+    with the client, and restart the pods of the controllers that were
+    replaced.'''
+    # The kube-system namespace must exist before the kubedns objects.
+    namespace = {'apiVersion': 'v1',
+                 'kind': 'Namespace',
+                 'metadata': {'name': 'kube-system'}}
+    manifests = [namespace]
+    # Add the objects from the rendered kubedns files.
+    manifests.extend(load_manifests('files/manifests/kubedns-rc.yaml',
+                                    'files/manifests/kubedns-svc.yaml'))
+    # Replace the existing objects when the rendered kubedns files changed.
+    replace = is_state('kubedns.changed')
+    controllers = [object_path(manifest) for manifest in manifests
+                   if manifest['kind'] == 'ReplicationController']
+    existing = [path for path in controllers if replace and client.get(path)]
+    # Create or update the objects in one pass over the same connection.
+    for path in client.apply(manifests, replace=replace):
+        hookenv.log('Applied {0}'.format(path))
+    for path in existing:
+        # The running pods keep the old template until they are recreated.
+        hookenv.log('Restarting the pods of {0}'.format(path))
+        remaining = client.restart_pods(path)
+        if remaining:
+            hookenv.log('The new kubedns pods are not ready, not restarting '
+                        '{0}.'.format(', '.join(remaining)))
+
+
 @when('skydns.available', 'leadership.is_leader')
 def convert_to_kubedns():
     '''Delete the skydns containers to make way for the kubedns containers.'''
     hookenv.log('Deleteing the old skydns deployment.')
-    # Delete the skydns replication controller.
-    return_code = call(split('kubectl delete rc kube-dns-v11'))
+    client = KubeClient(APISERVER)
+    if not client.wait_ready(timeout=300):
+        hookenv.log('The apiserver did not respond, will retry the removal.')
+        return
+    rc = '/api/v1/namespaces/kube-system/replicationcontrollers/kube-dns-v11'
+    if client.get(rc):
+        # The REST delete does not remove the pods, scale the controller down
+        # and wait for the pods to stop the way the kubectl reaper does.
+        if not client.scale_down(rc):
+            hookenv.log('The skydns pods did not stop in time.')
+        # Delete the skydns replication controller.
+        client.delete(rc)
+    # The skydns pods have the label the kubedns service selects, delete the
+    # pods that are left so they do not receive the DNS queries.
+    for name in client.delete_pods('kube-system',
+                                   'k8s-app=kube-dns,version=v11'):
+        hookenv.log('Deleted the skydns pod {0}.'.format(name))
     # Delete the skydns service.
-    return_code = call(split('kubectl delete svc kube-dns'))
+    client.delete('/api/v1/namespaces/kube-system/services/kube-dns')
+    client.close()
     remove_state('skydns.available')
 
 
+@hook('cluster-relation-joined')
+def publish_node_info():
+    '''Share the number of CPU cores of this unit with the other units.'''
+    hookenv.relation_set(relation_settings={
+        'cores': multiprocessing.cpu_count()})
+
+
+@hook('cluster-relation-changed', 'cluster-relation-departed',
+      'config-changed', 'leader-elected', 'update-status')
+def scale_dns():
+    '''Compute the number of kube-dns replicas from the number of units and
+    their cores, and scale the running replication controller in place when
+    its replica count is different. The count is compared with the live
+    controller, so a controller created with an older count is scaled too,
+    and a scale that failed is tried again in the next hook.'''
+    if not is_leader() or validate_config(hookenv.config()):
+        return
+    replicas = dns_replicas(*cluster_size())
+    if str(replicas) != str(leader_get('dns-replicas')):
+        # A controller that is launched later is created with this count.
+        leader_set({'dns-replicas': str(replicas)})
+    if not is_state('kubedns.available'):
+        return
+    client = KubeClient(APISERVER)
+    try:
+        # Only wait a short time, this runs in every update-status hook.
+        if not client.wait_ready(timeout=10):
+            hookenv.log('The apiserver did not respond, will retry scaling '
+                        'kube-dns.')
+            return
+        path = object_path(
+            load_manifests('files/manifests/kubedns-rc.yaml')[0])
+        controller = client.get(path)
+        if not controller or controller['spec'].get('replicas') == replicas:
+            return
+        hookenv.log('Scaling kube-dns from {0} to {1} replicas.'.format(
+            controller['spec'].get('replicas'), replicas))
+        # Patch the replica count without recreating the controller.
+        client.patch(path, {'spec': {'replicas': replicas}})
+    except (HTTPException, KubeAPIError, socket.error) as error:
+        hookenv.log('Failed to scale kube-dns, will retry: {0}'.format(
+            error))
+    finally:
+        client.close()
+
+
+@hook('cluster-relation-changed', 'cluster-relation-departed',
+      'update-status', 'leader-elected')
+def rolling_restart():
+    '''Coordinate the rolling restart of the nodes on the leader. The nodes
+    that need a restart are released in batches, and the next batch is only
+    released when the kubelets of the current batch report Ready after their
+    restart. The nodes are checked once in each hook, the hook does not wait
+    for them, and a restarted node sets restart-ready when its kubelet is
+    Ready so the leader checks again in the relation hook.'''
+    relation_id = cluster_relation_id()
+    if not is_leader() or not relation_id:
+        return
+    units = {}
+    for unit in hookenv.related_units(relation_id):
+        units[unit] = hookenv.relation_get(unit=unit, rid=relation_id) or {}
+    batch = [unit for unit in (leader_get('restart-batch') or '').split(',')
+             if unit in units]
+    if batch:
+        if any(restart_outstanding(units[unit]) for unit in batch):
+            hookenv.log('Waiting for {0} to restart.'.format(
+                ', '.join(batch)))
+            return
+        try:
+            not_ready = nodes_not_ready(batch, units)
+        except (HTTPException, KubeAPIError, socket.error) as error:
+            hookenv.log('Could not check the nodes, will retry: {0}'.format(
+                error))
+            return
+        db = unitdata.kv()
+        if not_ready:
+            # The timeout starts when the leader first saw the batch done.
+            waiting = db.get('restart.waiting')
+            if not waiting or waiting[0] != batch:
+                waiting = [batch, time.time()]
+                db.set('restart.waiting', waiting)
+            timeout = hookenv.config().get('restart_ready_timeout')
+            if time.time() - waiting[1] > timeout:
+                # Stop the rolling restart so the failure can be investigated.
+                status_set('blocked', 'Rolling restart stopped, not Ready: '
+                           '{0}'.format(', '.join(not_ready)))
+            else:
+                hookenv.log('Waiting for {0} to report Ready.'.format(
+                    ', '.join(not_ready)))
+            return
+        db.unset('restart.waiting')
+        hookenv.log('The nodes {0} are Ready.'.format(', '.join(batch)))
+    pending = sorted(unit for unit, data in units.items()
+                     if restart_outstanding(data))
+    size = hookenv.config().get('restart_batch_size')
+    batch = pending[:size]
+    if batch:
+        status_set('maintenance', 'Rolling restart of {0}, {1} pending.'
+                   .format(', '.join(batch), len(pending) - len(batch)))
+    elif leader_get('restart-batch'):
+        status_set('active', 'Rolling restart finished.')
+    if ','.join(batch) != (leader_get('restart-batch') or ''):
+        leader_set({'restart-batch': ','.join(batch)})
+
+
+@hook('cluster-relation-changed', 'update-status')
+def node_restarted():
+    '''Tell the leader when the kubelet of a restarted node reports Ready,
+    if it was not Ready yet when the services were started.'''
+    if not is_leader():
+        report_ready()
+
+
+@when('etcd-events.available')
+@when_not('etcd-events.configured')
+def configure_events_etcd(etcd_events):
+    '''When the etcd cluster for events is related, render the master pod
+    again so the apiserver stores the events in the separate cluster.'''
+    set_state('etcd-events.configured')
+    remove_state('kubelet.available')
+    remove_state('proxy.available')
+
+
+@when('etcd-events.configured')
+@when_not('etcd-events.available')
+def remove_events_etcd():
+    '''When the etcd cluster for events is removed, render the master pod
+    again so the apiserver stores the events with the other objects.'''
+    remove_state('etcd-events.configured')
+    remove_state('kubelet.available')
+    remove_state('proxy.available')
+
+
+@when('leadership.is_leader', 'kubelet.available')
+def publish_registry_cache():
+    '''Publish the addresses of the registry caches once they answer so the
+    units pull their images through them, or remove the addresses when the
+    caches are disabled. The caches stay on the unit that started them when
+    the leadership changes, so the addresses the docker daemons use only
+    change when that unit leaves and the leader starts the caches itself.'''
+    unit = address = hub = gcr = None
+    if hookenv.config().get('registry_cache'):
+        unit, address = registry_host()
+        if not unit:
+            unit = hookenv.local_unit()
+            address = hookenv.unit_private_ip()
+        port = hookenv.config().get('registry_cache_port')
+        hub = '{0}:{1}'.format(address, port)
+        gcr = '{0}:{1}'.format(address, port + 1)
+    if (leader_get('registry-unit') or None) != unit:
+        hookenv.log('The registry caches run on {0}.'.format(unit))
+        # The addresses are published again when the new caches answer.
+        leader_set({'registry-unit': unit, 'registry-address': None,
+                    'gcr-registry-address': None})
+        return
+    if leader_get('registry-address') == hub and \
+            leader_get('gcr-registry-address') == gcr:
+        return
+    # The caches of this unit are checked on the loopback address.
+    host = '127.0.0.1' if unit == hookenv.local_unit() else address
+    if hub and not (registry_ready(port, host) and
+                    registry_ready(port + 1, host)):
+        hookenv.log('The registry caches are not ready, checking again in '
+                    'the next hook.')
+        return
+    leader_set({'registry-address': hub, 'gcr-registry-address': gcr})
+
+
+@when('docker.available')
+def configure_registry_mirror():
+    '''Configure the docker daemon to use the registry caches the leader
+    published, and restart docker when the addresses change. Restarting
+    docker restarts every container on the unit, so the nodes wait for a
+    slot in the rolling restart and the leader waits until the nodes are
+    done.'''
+    addresses = [leader_get('registry-address'),
+                 leader_get('gcr-registry-address')]
+    db = unitdata.kv()
+    previous = db.get('registry.docker', [None, None])
+    if addresses == previous:
+        return
+    if is_leader():
+        if leader_get('restart-batch'):
+            hookenv.log('Waiting for the rolling restart of the nodes '
+                        'before restarting docker.')
+            return
+    elif restart_pending(docker=True):
+        status_set('waiting', 'Waiting for a rolling restart slot to '
+                   'restart docker.')
+        return
+    opts = DockerOpts()
+    # The caches serve plain HTTP on the private network.
+    if previous[0]:
+        opts.remove('registry-mirror', 'http://{0}'.format(previous[0]))
+    for address in previous:
+        if address:
+            opts.remove('insecure-registry', address)
+    if addresses[0]:
+        opts.add('registry-mirror', 'http://{0}'.format(addresses[0]))
+    for address in addresses:
+        if address:
+            opts.add('insecure-registry', address)
+    db.set('registry.docker', addresses)
+    hookenv.log('Configuring docker to use the registry caches: {0}'.format(
+        ', '.join(address for address in addresses if address) or 'none'))
+    set_state('docker.restart')
+    set_state('registry.mirror.changed')
+
+
+@when('registry.mirror.changed')
+@when_not('docker.restart')
+def use_registry_mirror():
+    '''When docker restarted with the registry caches, pull the gcr.io images
+    through the gcr.io cache. The rendered files keep the gcr.io names, so
+    the services do not restart and still pull from gcr.io when the cache is
+    not available.'''
+    db = unitdata.kv()
+    db.set('registry.images', db.get('registry.docker'))
+    remove_state('registry.mirror.changed')
+
+
+@when('kubelet.available')
+def registry_unit_changed():
+    '''When the leader moves the registry caches to or from this unit,
+    render the files again so the caches are started or stopped.'''
+    running = 'registry' in unitdata.kv().get('k8s.services', [])
+    if running != ('registry' in unit_services()):
+        remove_state('kubelet.available')
+        remove_state('proxy.available')
+
+
+@when('kubelet.available')
+def masters_changed():
+    '''When the leader changes the masters, render the files again so this
+    unit runs the master pod or the node services and the load balancer
+    follows the masters.'''
+    masters = [leader_get('masters'), leader_get('master-addresses')]
+    db = unitdata.kv()
+    if db.get('k8s.masters') == masters:
+        return
+    hookenv.log('The masters changed: {0}'.format(masters[1]))
+    # Certificates requested from now on are valid for the new masters.
+    db.set('extra_sans', extra_sans())
+    remove_state('kubelet.available')
+    remove_state('proxy.available')
+    # Point the kubeconfig files at the new apiserver address.
+    remove_state('kubeconfig.created')
+
+
+@when('docker.available')
+@when_not('zfs.configured', 'zfs.docker.pending')
+def configure_zfs():
+    '''Put the docker and kubelet data in their own ZFS datasets on the pool
+    that holds /srv/kubernetes and tune the datasets before the services
+    start. Without ZFS the data stays on the root disk.'''
+    config = hookenv.config()
+    errors = validate_config(config)
+    if errors:
+        status_set('blocked', 'Invalid configuration: {0}'.format(
+            '; '.join(errors)))
+        return
+    dataset = zfs.dataset_of(KUBERNETES_DIR)
+    if not dataset:
+        hookenv.log('{0} is not on ZFS, leaving the docker and kubelet data '
+                    'on the root disk.'.format(KUBERNETES_DIR))
+        set_state('zfs.configured')
+        return
+    status_set('maintenance', 'Configuring the ZFS datasets.')
+    if zfs.set_arc_max(config.get('zfs_arc_max') * 1024 * 1024):
+        hookenv.log('Changed the ZFS ARC limit.')
+    zfs.set_properties(dataset, zfs_properties('kubernetes'))
+    pool = dataset.split('/')[0]
+    # The data of running services is not moved, only new units are changed.
+    started = unitdata.kv().get('k8s.fingerprints') is not None
+    docker_created = False
+    for name, path in (('docker', DOCKER_DIR), ('kubelet', KUBELET_DIR)):
+        target = '{0}/{1}'.format(pool, name)
+        properties = zfs_properties(name)
+        if zfs.dataset_exists(target):
+            zfs.set_properties(target, properties)
+        elif started:
+            hookenv.log('Not moving {0} to ZFS while the services are '
+                        'running.'.format(path))
+        else:
+            if name == 'docker':
+                # Docker keeps files open in its directory.
+                check_call(['service', 'docker', 'stop'])
+            moved = zfs.create_dataset(target, path, properties)
+            if moved and name == 'docker':
+                # The images of the old storage driver are not used by zfs.
+                hookenv.log('The old docker data is in {0}.'.format(moved))
+            elif moved:
+                zfs.restore_files(moved, path)
+            docker_created = docker_created or name == 'docker'
+    if docker_created:
+        opts = DockerOpts()
+        opts.add('storage-driver', 'zfs')
+        # Start docker with the zfs storage driver before the services.
+        set_state('docker.restart')
+        set_state('zfs.docker.pending')
+        return
+    set_state('zfs.configured')
+
+
+@when('zfs.docker.pending')
+@when_not('docker.restart')
+def zfs_docker_restarted():
+    '''Docker restarted with the zfs storage driver, the services can start.
+    '''
+    remove_state('zfs.docker.pending')
+    set_state('zfs.configured')
+
+
 @when('docker.available')
 @when_not('etcd.available')
 def relation_message():
@@ -181,48 +682,124 @@ def relation_message():
     status_set('waiting', 'Waiting for relation to ETCD')
 
 
-@when('kubeconfig.created')
+@when('kubeconfig.created', 'zfs.configured')
 @when('etcd.available')
 @when_not('kubelet.available', 'proxy.available')
 def start_kubelet(etcd):
     '''Run the hyperkube container that starts the kubernetes services.
-    When the leader, run the master services (apiserver, controller, scheduler,
+    When a master, run the master services (apiserver, controller, scheduler,
     proxy)
     using the master.json from the rendered manifest directory.
-    When a follower, start the node services (kubelet, and proxy). '''
-    render_files(etcd)
+    When a node, start the node services (kubelet, and proxy) and the
+    apiserver load balancer when there is more than one master.
+    Services whose rendered configuration did not change are left running.'''
+    errors = validate_config(hookenv.config())
+    if errors:
+        # Keep the running services until the configuration is corrected.
+        status_set('blocked', 'Invalid configuration: {0}'.format(
+            '; '.join(errors)))
+        return
+    if not is_leader() and restart_pending():
+        # Another batch of nodes is restarting, wait for the leader.
+        status_set('waiting', 'Waiting for a rolling restart slot.')
+        return
+    changed, fingerprints = render_files(etcd)
     # Use the Compose class that encapsulates the docker-compose commands.
     compose = Compose('files/kubernetes')
     status_set('maintenance', 'Starting the Kubernetes services.')
-    if is_leader():
-        compose.up('master')
-        compose.up('proxy')
-        set_state('kubelet.available')
+    services = unit_services()
+    db = unitdata.kv()
+    for service in db.get('k8s.services', []):
+        if service not in services and service != 'cadvisor':
+            # The role of this unit changed or the service was disabled.
+            hookenv.log('Stopping the {0} service.'.format(service))
+            compose.kill(service)
+            compose.rm(service)
+    for service in services:
+        if service in changed:
+            hookenv.log('The {0} configuration changed, restarting.'.format(
+                service))
+            # Stop and remove the container so it is created again.
+            compose.kill(service)
+            compose.rm(service)
+        # Unchanged containers that are already running are left alone.
+        compose.up(service)
+    db.set('k8s.services', services)
+    # Only remember the configuration once the services run with it, the
+    # master.json is mounted in the master container so compose can not see
+    # that it changed when a restart failed.
+    db.set('k8s.fingerprints', fingerprints)
+    db.set('k8s.masters', [leader_get('masters'),
+                           leader_get('master-addresses')])
+    if 'registry' in services:
+        set_state('registry.available')
+    else:
+        remove_state('registry.available')
+    if is_master():
         # Open the secure port for api-server.
         hookenv.open_port(6443)
     else:
-        # Start the Kubernetes kubelet container using docker-compose.
-        compose.up('kubelet')
+        hookenv.close_port(6443)
+    if is_leader():
+        set_state('kubelet.available')
+        if 'kubedns' in changed:
+            # Make launch_dns update the kubedns objects in the cluster.
+            set_state('kubedns.changed')
+            remove_state('kubedns.available')
+    else:
         set_state('kubelet.available')
-        # Start the Kubernetes proxy container using docker-compose.
-        compose.up('proxy')
         set_state('proxy.available')
+        # Tell the leader this node finished its part of a rolling restart.
+        finish_restart()
+        report_ready(NODE_READY_WAIT)
     status_set('active', 'Kubernetes services started')
 
 
 @when('docker.available')
 @when_not('kubectl.downloaded')
 def download_kubectl():
-    '''Download the kubectl binary to test and interact with the cluster.'''
-    status_set('maintenance', 'Downloading the kubectl binary')
-    version = hookenv.config()['version']
-    cmd = 'wget -nv -O /usr/local/bin/kubectl https://storage.googleapis.com' \
-          '/kubernetes-release/release/{0}/bin/linux/{1}/kubectl'
-    cmd = cmd.format(version, arch())
-    hookenv.log('Downloading kubelet: {0}'.format(cmd))
-    check_call(split(cmd))
-    cmd = 'chmod +x /usr/local/bin/kubectl'
-    check_call(split(cmd))
+    '''Download the kubectl binary to test and interact with the cluster.
+    The binary is kept in a cache on the storage mount so a version that was
+    downloaded before is installed without using the network.'''
+    config = hookenv.config()
+    version = config['version']
+    architecture = arch()
+    # An empty checksum trusts the first download and records the checksum.
+    expected = config.get('kubectl_sha256') or None
+    limit = config.get('artifact_cache_size') * 1024 * 1024
+    cache = ArtifactCache(os.path.join(KUBERNETES_DIR, 'cache'), limit)
+    path = cache.get('kubectl', version, architecture, expected)
+    db = unitdata.kv()
+    if path:
+        hookenv.log('Using the cached kubectl {0}'.format(path))
+    else:
+        try:
+            source = kubectl_source(version, architecture)
+        except ArtifactError as error:
+            status_set('blocked', str(error))
+            return
+        # A download that did not match the checksum is not repeated until
+        # the source, version or checksum changes.
+        attempt = [source, version, architecture, expected]
+        mismatch = db.get('kubectl.mismatch')
+        if mismatch and mismatch[0] == attempt:
+            status_set('blocked', mismatch[1])
+            return
+        status_set('maintenance', 'Downloading the kubectl binary')
+        hookenv.log('Downloading kubectl: {0}'.format(source))
+        try:
+            path = cache.fetch('kubectl', version, architecture, source,
+                               expected)
+        except ChecksumError as error:
+            db.set('kubectl.mismatch', [attempt, str(error)])
+            status_set('blocked', str(error))
+            return
+        except ArtifactError as error:
+            status_set('blocked', str(error))
+            return
+        db.unset('kubectl.mismatch')
+    # Hard link or copy the binary in to place with an atomic rename.
+    install_artifact(path, KUBECTL)
     set_state('kubectl.downloaded')
 
 
@@ -232,24 +809,24 @@ def master_kubeconfig():
     '''Create the kubernetes configuration for the master unit. The master
     should create a package with the client credentials so the user can
     interact securely with the apiserver.'''
+    errors = validate_config(hookenv.config())
+    if errors:
+        # The package is built again when the configuration is corrected.
+        status_set('blocked', 'Invalid configuration: {0}'.format(
+            '; '.join(errors)))
+        return
     hookenv.log('Creating Kubernetes configuration for master node.')
-    directory = '/srv/kubernetes'
-    ca = '/srv/kubernetes/ca.crt'
-    key = '/srv/kubernetes/client.key'
-    cert = '/srv/kubernetes/client.crt'
+    directory = KUBERNETES_DIR
+    ca = os.path.join(KUBERNETES_DIR, 'ca.crt')
+    key = os.path.join(KUBERNETES_DIR, 'client.key')
+    cert = os.path.join(KUBERNETES_DIR, 'client.crt')
     # Get the public address of the apiserver so users can access the master.
     server = 'https://{0}:{1}'.format(hookenv.unit_public_ip(), '6443')
+    embed = hookenv.config().get('embed_certificates')
     # Create the client kubeconfig so users can access the master node.
-    create_kubeconfig(directory, server, ca, key, cert)
-    # Copy the kubectl binary to this directory.
-    cmd = 'cp -v /usr/local/bin/kubectl {0}'.format(directory)
-    check_call(split(cmd))
-    # Use a context manager to run the tar command in a specific directory.
-    with chdir(directory):
-        # Create a package with kubectl and the files to use it externally.
-        cmd = 'tar -cvzf /home/ubuntu/kubectl_package.tar.gz ca.crt ' \
-              'client.key client.crt kubectl kubeconfig'
-        check_call(split(cmd))
+    create_kubeconfig(directory, server, ca, key, cert, embed=embed)
+    # Create a package with kubectl and the files to use it externally.
+    build_kubectl_package(directory)
 
     # This sets up the client workspace consistently on the leader and nodes.
     node_kubeconfig()
@@ -263,18 +840,22 @@ def node_kubeconfig():
     The the nodes will create a kubeconfig with the server credentials so
     the services can interact securely with the apiserver.'''
     hookenv.log('Creating Kubernetes configuration for worker node.')
-    directory = '/var/lib/kubelet'
-    ca = '/srv/kubernetes/ca.crt'
-    cert = '/srv/kubernetes/server.crt'
-    key = '/srv/kubernetes/server.key'
-    # Get the private address of the apiserver for communication between units.
-    server = 'https://{0}:{1}'.format(leader_get('master-address'), '6443')
+    directory = KUBELET_DIR
+    ca = os.path.join(KUBERNETES_DIR, 'ca.crt')
+    cert = os.path.join(KUBERNETES_DIR, 'server.crt')
+    key = os.path.join(KUBERNETES_DIR, 'server.key')
+    # Use the same apiserver address as the services on this unit.
+    server = 'https://{0}:{1}'.format(apiserver_host(), '6443')
+    embed = hookenv.config().get('embed_certificates')
     # Create the kubeconfig for the other services.
-    kubeconfig = create_kubeconfig(directory, server, ca, key, cert)
+    kubeconfig = create_kubeconfig(directory, server, ca, key, cert,
+                                   embed=embed)
     # Install the kubeconfig in the root user's home directory.
-    install_kubeconfig(kubeconfig, '/root/.kube', 'root')
+    install_kubeconfig(kubeconfig, os.path.expanduser('~root/.kube'),
+                       'root')
     # Install the kubeconfig in the ubunut user's home directory.
-    install_kubeconfig(kubeconfig, '/home/ubuntu/.kube', 'ubuntu')
+    install_kubeconfig(kubeconfig, os.path.expanduser('~ubuntu/.kube'),
+                       'ubuntu')
     set_state('kubeconfig.created')
 
 
@@ -291,11 +872,71 @@ def start_cadvisor():
 
 
 @when('kubelet.available', 'kubeconfig.created')
-@when_any('proxy.available', 'cadvisor.available', 'skydns.available')
 def final_message():
-    '''Issue some final messages when the services are started. '''
-    # TODO: Run a simple/quick health checks before issuing this message.
-    status_set('active', 'Kubernetes running.')
+    '''Check the health of the services on this unit, the leader included,
+    and issue the final message with the latency of each check, or the
+    checks that failed. The checks only run in the update-status hook, the
+    other hooks report the results it saved. '''
+    saved = unitdata.kv().get('health.probes')
+    if hookenv.hook_name() == 'update-status' or not saved:
+        results = check_health()
+    else:
+        results = saved['results']
+    batch = leader_get('restart-batch')
+    if is_leader() and batch:
+        # Keep the rolling restart progress visible on the leader.
+        status_set('maintenance', 'Rolling restart of {0}.'.format(batch))
+        return
+    failed = sorted(name for name, result in results.items()
+                    if not result['healthy'])
+    if failed:
+        for name in failed:
+            hookenv.log('The {0} health check failed: {1}'.format(
+                name, results[name]['error']))
+        status_set('waiting', 'Kubernetes running, unhealthy: {0}'.format(
+            ', '.join(failed)))
+        return
+    status_set('active', 'Kubernetes running ({0}).'.format(', '.join(
+        '{0} {1:.0f}ms'.format(name, results[name]['seconds'] * 1000)
+        for name in sorted(results))))
+
+
+def health_probes(timeout):
+    '''Return a dictionary of the health probes of the services that run on
+    this unit.'''
+    probes = {
+        'kubelet': http_probe('127.0.0.1', 10250, timeout=timeout, tls=True),
+        'proxy': http_probe('127.0.0.1', 10249, timeout=timeout),
+    }
+    if is_state('cadvisor.available'):
+        probes['cadvisor'] = http_probe('127.0.0.1', 8088, timeout=timeout)
+    if 'apiserver-lb' in unit_services():
+        probes['apiserver-lb'] = http_probe('127.0.0.1', 8080,
+                                            timeout=timeout)
+    if is_master():
+        probes['apiserver'] = http_probe('127.0.0.1', 8080, timeout=timeout)
+        probes['apiserver-tls'] = http_probe(
+            '127.0.0.1', 6443, timeout=timeout, tls=True,
+            ca=os.path.join(KUBERNETES_DIR, 'ca.crt'),
+            key=os.path.join(KUBERNETES_DIR, 'client.key'),
+            cert=os.path.join(KUBERNETES_DIR, 'client.crt'))
+    if is_leader() and is_state('kubedns.available'):
+        pillar = gather_sdn_data()['pillar']
+        name = 'kubernetes.default.svc.{0}'.format(pillar['dns_domain'])
+        probes['dns'] = dns_probe(pillar['dns_server'], name, DNS_PORT,
+                                  timeout)
+    return probes
+
+
+def check_health():
+    '''Run the health probes at the same time and save the results for the
+    collect-metrics hook. A full check takes at most a second longer than
+    the probe timeout.'''
+    timeout = hookenv.config().get('health_probe_timeout')
+    results = run_probes(health_probes(timeout), timeout + 1)
+    unitdata.kv().set('health.probes', {'time': time.time(),
+                                        'results': results})
+    return results
 
 
 def gather_sdn_data():
@@ -315,7 +956,11 @@ def gather_sdn_data():
         # There is no SDN cider fall back to the kubernetes config cidr option.
         pillar['dns_server'] = get_dns_ip(hookenv.config().get('cidr'))
     # The pillar['dns_server'] value is used the kubedns-svc.yaml file.
-    pillar['dns_replicas'] = 1
+    # The leader computes the number of replicas from the cluster size.
+    replicas = leader_get('dns-replicas')
+    if not replicas:
+        replicas = hookenv.config().get('dns_min_replicas')
+    pillar['dns_replicas'] = replicas
     # The pillar['dns_domain'] value is used in the kubedns-rc.yaml
     pillar['dns_domain'] = hookenv.config().get('dns_domain')
     # Use a 'pillar' dictionary so we can reuse the upstream kubedns templates.
@@ -323,54 +968,349 @@ def gather_sdn_data():
     return sdn_data
 
 
+def cluster_size():
+    '''Return the number of units and the total number of CPU cores in the
+    cluster using the values the units share on the peer relation.'''
+    nodes = 1
+    cores = multiprocessing.cpu_count()
+    for relation_id in hookenv.relation_ids('cluster'):
+        for unit in hookenv.related_units(relation_id):
+            nodes += 1
+            # A unit that has not shared the cores yet counts as one core.
+            cores += int(hookenv.relation_get('cores', unit, relation_id) or 1)
+    return nodes, cores
+
+
+def dns_replicas(nodes, cores):
+    '''Return the number of kube-dns replicas for a cluster of this size,
+    enough for both the nodes and the cores per replica options and limited
+    to the minimum and maximum options.'''
+    config = hookenv.config()
+    replicas = max(math.ceil(nodes / config.get('dns_nodes_per_replica')),
+                   math.ceil(cores / config.get('dns_cores_per_replica')))
+    replicas = max(replicas, config.get('dns_min_replicas'))
+    return int(min(replicas, config.get('dns_max_replicas')))
+
+
+def is_master():
+    '''Return True when this unit runs the master services, the leader is
+    always a master.'''
+    if is_leader():
+        return True
+    masters = (leader_get('masters') or '').split(',')
+    return hookenv.local_unit() in masters
+
+
+def select_masters(count):
+    '''Return the unit names and the addresses of the masters. The leader is
+    the first master, followed by the peers that are already masters and
+    then the other peers in the order they were added, up to count.'''
+    local = hookenv.local_unit()
+    addresses = {local: hookenv.unit_private_ip()}
+    relation_id = cluster_relation_id()
+    if relation_id:
+        for unit in hookenv.related_units(relation_id):
+            address = hookenv.relation_get('private-address', unit,
+                                           relation_id)
+            if address:
+                addresses[unit] = address
+    current = [unit for unit in (leader_get('masters') or '').split(',')
+               if unit in addresses and unit != local]
+    others = sorted((unit for unit in addresses
+                     if unit != local and unit not in current),
+                    key=lambda unit: int(unit.split('/')[-1]))
+    masters = ([local] + current + others)[:count]
+    return masters, [addresses[unit] for unit in masters]
+
+
+def extra_sans():
+    '''Return the extra subject alternative names that the tls layer adds to
+    the server certificate: the service names, the addresses of the masters
+    and the local address the load balancer on the nodes listens on.'''
+    domain = hookenv.config().get('dns_domain')
+    cidr = hookenv.config().get('cidr')
+    sdn_ip = get_sdn_ip(cidr)
+    sans = [
+        sdn_ip,
+        'kubernetes',
+        'kubernetes.{0}'.format(domain),
+        'kubernetes.default',
+        'kubernetes.default.svc',
+        'kubernetes.default.svc.{0}'.format(domain),
+        '127.0.0.1',
+    ]
+    for address in (leader_get('master-addresses') or '').split(','):
+        if address and address not in sans:
+            sans.append(address)
+    return sans
+
+
+def generate_service_account_key():
+    '''Return a new RSA private key in PEM format for the service account
+    tokens.'''
+    return check_output(['openssl', 'genrsa', '2048'],
+                        stderr=DEVNULL).decode('utf-8')
+
+
+def auth_file(key):
+    '''Return the content of the basic auth or token file the apiserver on
+    this unit already uses, so its credentials stay valid, or a new file
+    with random credentials.'''
+    path = os.path.join(KUBERNETES_DIR, AUTH_FILES[key])
+    if os.path.isfile(path):
+        with open(path) as stream:
+            return stream.read()
+    if key == 'basic-auth':
+        return '{0},admin,admin\n'.format(new_token())
+    return ''.join('{0},{1},{1}\n'.format(new_token(), user)
+                   for user in ('admin', 'kubelet', 'kube_proxy'))
+
+
+def new_token():
+    '''Return a random token of 32 hexadecimal characters.'''
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+def service_account_key():
+    '''Return the path and content of the service account key the leader
+    shares with the masters, or None when the master signs the tokens with
+    its server key.'''
+    content = leader_get('service-account-key')
+    if not content:
+        return None
+    return {'path': os.path.join(KUBERNETES_DIR, 'service-account.key'),
+            'content': content}
+
+
+def apiserver_host():
+    '''Return the address the services and kubectl on this unit use to
+    reach the apiserver.'''
+    if is_master():
+        # The master services use the apiserver on this unit.
+        return hookenv.unit_get('private-address')
+    masters = [address for address in
+               (leader_get('master-addresses') or '').split(',') if address]
+    if len(masters) > 1:
+        # The load balancer on this unit spreads the requests over the
+        # masters.
+        return '127.0.0.1'
+    return leader_get('master-address')
+
+
+def cluster_relation_id():
+    '''Return the id of the peer relation or None when there are no peers.'''
+    relation_ids = hookenv.relation_ids('cluster')
+    return relation_ids[0] if relation_ids else None
+
+
+def restart_outstanding(data):
+    '''Return True when the relation data of a unit has a restart request
+    that was not completed.'''
+    request = data.get('restart-request')
+    return bool(request) and request != data.get('restart-done')
+
+
+def restart_pending(docker=False):
+    '''Return True when this node must wait for the leader before restarting
+    services, or before restarting the docker daemon when docker is True.
+    The first time the services start, and units without peers, never wait.
+    A request is sent to the leader on the peer relation.'''
+    relation_id = cluster_relation_id()
+    if not relation_id or not unitdata.kv().get('k8s.fingerprints'):
+        return False
+    local = hookenv.relation_get(unit=hookenv.local_unit(),
+                                 rid=relation_id) or {}
+    if not restart_outstanding(local):
+        if not docker:
+            # Check if the new configuration restarts any service here.
+            changed, _ = render_files(
+                RelationBase.from_state('etcd.available'), dry_run=True)
+            if not any(service in changed for service in unit_services()):
+                return False
+        hookenv.log('Requesting a rolling restart slot from the leader.')
+        hookenv.relation_set(relation_id, {'restart-request': time.time()})
+        return True
+    batch = (leader_get('restart-batch') or '').split(',')
+    return hookenv.local_unit() not in batch
+
+
+def finish_restart():
+    '''Mark the restart request of this node as done on the peer relation.'''
+    relation_id = cluster_relation_id()
+    if not relation_id:
+        return
+    local = hookenv.relation_get(unit=hookenv.local_unit(),
+                                 rid=relation_id) or {}
+    if restart_outstanding(local):
+        # The kubelet on this node reports the Ready condition with the same
+        # clock, so the leader can tell a report from after the restart.
+        hookenv.relation_set(relation_id, {
+            'restart-done': local.get('restart-request'),
+            'restarted-at': time.time()})
+
+
+def report_ready(timeout=0):
+    '''Set restart-ready on the peer relation when the kubelet of this node
+    reported Ready after its last restart, checking for up to the timeout in
+    seconds. The change runs the relation hook on the leader, which checks
+    the batch again without waiting for the next update-status hook.'''
+    relation_id = cluster_relation_id()
+    if not relation_id:
+        return
+    local = hookenv.relation_get(unit=hookenv.local_unit(),
+                                 rid=relation_id) or {}
+    done = local.get('restart-done')
+    if not done or done == local.get('restart-ready'):
+        return
+    # The node reads its own node object with the kubelet credentials.
+    client = KubeClient('https://{0}:6443'.format(apiserver_host()),
+                        ca=os.path.join(KUBERNETES_DIR, 'ca.crt'),
+                        key=os.path.join(KUBERNETES_DIR, 'server.key'),
+                        cert=os.path.join(KUBERNETES_DIR, 'server.crt'))
+    name = hookenv.unit_get('private-address')
+    since = float(local.get('restarted-at') or 0)
+    try:
+        ready = poll(lambda: node_ready(client, name, since), timeout, 2)
+    except (HTTPException, KubeAPIError, socket.error) as error:
+        hookenv.log('Could not check the node, will retry: {0}'.format(
+            error))
+        return
+    finally:
+        client.close()
+    if ready:
+        hookenv.relation_set(relation_id, {'restart-ready': done})
+
+
+def nodes_not_ready(batch, units):
+    '''Return the units in the batch whose kubelets have not reported the
+    Ready condition since they restarted.'''
+    client = KubeClient(APISERVER)
+    try:
+        return [unit for unit in batch if not node_ready(
+            client, units[unit].get('private-address'),
+            float(units[unit].get('restarted-at') or 0))]
+    finally:
+        client.close()
+
+
+def node_ready(client, name, since=0):
+    '''Return True when the node has the Ready condition and the kubelet
+    reported it after the since time, a Ready condition that was reported
+    before the kubelet restarted does not count.'''
+    node = client.get('/api/v1/nodes/{0}'.format(name))
+    conditions = ((node or {}).get('status') or {}).get('conditions') or []
+    for condition in conditions:
+        if condition.get('type') != 'Ready' or \
+                condition.get('status') != 'True':
+            continue
+        times = [parse_timestamp(condition[key]) for key in
+                 ('lastHeartbeatTime', 'lastTransitionTime')
+                 if condition.get(key)]
+        return bool(times) and max(times) > since
+    return False
+
+
 def install_kubeconfig(kubeconfig, directory, user):
     '''Copy the a file from the target to a new directory creating directories
     if necessary. '''
     # The file and directory must be owned by the correct user.
-    chown = 'chown {0}:{0} {1}'
     if not os.path.isdir(directory):
         os.makedirs(directory)
-        # Change the ownership of the config file to the right user.
-        check_call(split(chown.format(user, directory)))
+        # Change the ownership of the directory to the right user.
+        user_info = pwd.getpwnam(user)
+        os.chown(directory, user_info.pw_uid, user_info.pw_gid)
     # kubectl looks for a file named "config" in the ~/.kube directory.
     config = os.path.join(directory, 'config')
-    # Copy the kubeconfig file to the directory renaming it to "config".
-    cmd = 'cp -v {0} {1}'.format(kubeconfig, config)
-    check_call(split(cmd))
-    # Change the ownership of the config file to the right user.
-    check_call(split(chown.format(user, config)))
+    with open(kubeconfig, 'rb') as stream:
+        content = stream.read()
+    # Write the kubeconfig content to "config" owned by the right user.
+    if atomic_write(config, content, owner=user, perms=0o600):
+        hookenv.log('Installed kubectl configuration at {0}.'.format(config))
 
 
-def create_kubeconfig(directory, server, ca, key, cert, user='ubuntu'):
+def create_kubeconfig(directory, server, ca, key, cert, user='ubuntu',
+                      embed=False):
     '''Create a configuration for kubernetes in a specific directory using
-    the supplied arguments, return the path to the file.'''
-    context = 'default-context'
-    cluster_name = 'kubernetes'
-    # Ensure the destination directory exists.
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    the supplied arguments, return the path to the file. When embed is True
+    the certificate data is included inline in the configuration.'''
     # The configuration file should be in this directory named kubeconfig.
     kubeconfig = os.path.join(directory, 'kubeconfig')
-    # Create the config file with the address of the master server.
-    cmd = 'kubectl config set-cluster --kubeconfig={0} {1} ' \
-          '--server={2} --certificate-authority={3}'
-    check_call(split(cmd.format(kubeconfig, cluster_name, server, ca)))
-    # Create the credentials using the client flags.
-    cmd = 'kubectl config set-credentials --kubeconfig={0} {1} ' \
-          '--client-key={2} --client-certificate={3}'
-    check_call(split(cmd.format(kubeconfig, user, key, cert)))
-    # Create a default context with the cluster.
-    cmd = 'kubectl config set-context --kubeconfig={0} {1} ' \
-          '--cluster={2} --user={3}'
-    check_call(split(cmd.format(kubeconfig, context, cluster_name, user)))
-    # Make the config use this new context.
-    cmd = 'kubectl config use-context --kubeconfig={0} {1}'
-    check_call(split(cmd.format(kubeconfig, context)))
-
-    hookenv.log('kubectl configuration created at {0}.'.format(kubeconfig))
+    # Write the cluster, credentials and context without calling kubectl.
+    if write_kubeconfig(kubeconfig, server, ca, key, cert, user, embed):
+        hookenv.log('kubectl configuration created at {0}.'.format(kubeconfig))
     return kubeconfig
 
 
+def build_kubectl_package(directory):
+    '''Build the kubectl package for users when any of the files in it
+    changed since the last build.'''
+    package = os.path.expanduser('~ubuntu/kubectl_package.tar.gz')
+    members = [('kubectl', KUBECTL)]
+    for name in ['ca.crt', 'client.key', 'client.crt', 'kubeconfig']:
+        members.append((name, os.path.join(directory, name)))
+    level = hookenv.config().get('kubectl_package_compression')
+    inputs = members_digest(members)
+    inputs['compression'] = level
+    db = unitdata.kv()
+    if os.path.isfile(package) and db.get('kubectl-package.inputs') == inputs:
+        hookenv.log('The kubectl package is up to date.')
+    else:
+        hookenv.log('Creating the kubectl package {0}'.format(package))
+        user = pwd.getpwnam('ubuntu')
+        # The package contains the client key so only ubuntu can read it.
+        write_tarball(package, members, level, perms=0o600,
+                      uid=user.pw_uid, gid=user.pw_gid)
+        db.set('kubectl-package.inputs', inputs)
+    set_state('kubectl.package.created')
+
+
+def kubectl_source(version, architecture):
+    '''Return the url or local path to get the kubectl binary from, using the
+    charm resource when the kubectl_source option is "resource".'''
+    source = hookenv.config().get('kubectl_source')
+    if source == 'resource':
+        source = hookenv.resource_get('kubectl')
+        if not source:
+            raise ArtifactError('The kubectl resource is not available')
+        return source
+    return source.format(version=version, arch=architecture)
+
+
+def validate_config(config):
+    '''Check the configuration values the templates use and return a list
+    of the problems that were found.'''
+    errors = []
+    for key, minimum in sorted(MINIMUM_VALUES.items()):
+        if config.get(key) is None or config.get(key) < minimum:
+            errors.append('{0} must be at least {1}'.format(key, minimum))
+    for key, maximum in sorted(MAXIMUM_VALUES.items()):
+        if (config.get(key) or 0) > maximum:
+            errors.append('{0} must be at most {1}'.format(key, maximum))
+    for key, other in sorted(LOWER_BOUNDS.items()):
+        if (config.get(key) or 0) < (config.get(other) or 0):
+            errors.append('{0} must not be lower than {1}'.format(key, other))
+    for key in QUANTITY_OPTIONS:
+        if not QUANTITY.match(config.get(key) or ''):
+            errors.append('{0} must be a quantity such as "100m"'.format(key))
+    for key in DURATION_OPTIONS:
+        if not DURATION.match(config.get(key) or ''):
+            errors.append('{0} must be a duration such as "3m"'.format(key))
+    for key, choices in sorted(CHOICES.items()):
+        if config.get(key) not in choices:
+            errors.append('{0} must be one of {1}'.format(
+                key, ', '.join(choices)))
+    for dataset in ZFS_DATASETS:
+        key = 'zfs_{0}_recordsize'.format(dataset)
+        if not RECORDSIZE.match(config.get(key) or ''):
+            errors.append('{0} must be a power of two from 512 to 1M such as '
+                          '"128K"'.format(key))
+    sizes = config.get('apiserver_watch_cache_sizes')
+    if sizes and not WATCH_CACHE_SIZES.match(sizes):
+        errors.append('apiserver_watch_cache_sizes must be in the format '
+                      '"resource#size,resource#size"')
+    return errors
+
+
 def get_dns_ip(cidr):
     '''Get an IP address for the DNS server on the provided cidr.'''
     # Remove the range from the cidr.
@@ -387,14 +1327,20 @@ def get_sdn_ip(cidr):
     return '.'.join(ip.split('.')[0:-1]) + '.1'
 
 
-def render_files(reldata=None):
+def render_files(reldata=None, dry_run=False, overrides=None):
     '''Use jinja templating to render the docker-compose.yml and master.json
-    file to contain the dynamic data for the configuration files.'''
+    file to contain the dynamic data for the configuration files. Return the
+    names of the services whose rendered configuration changed since the
+    services were last started, and the new fingerprints to save once they
+    have been restarted. When dry_run is True nothing is written. The
+    overrides replace charm configuration values to preview a configuration
+    change.'''
     context = {}
     # Load the context data with SDN data.
     context.update(gather_sdn_data())
     # Add the charm configuration data to the context.
     context.update(hookenv.config())
+    context.update(overrides or {})
     if reldata:
         connection_string = reldata.get_connection_string()
         # Define where the etcd tls files will be kept.
@@ -403,8 +1349,19 @@ def render_files(reldata=None):
         ca = os.path.join(etcd_dir, 'client-ca.pem')
         key = os.path.join(etcd_dir, 'client-key.pem')
         cert = os.path.join(etcd_dir, 'client-cert.pem')
-        # Save the client credentials (in relation data) to the paths provided.
-        reldata.save_client_credentials(key, cert, ca)
+        if not dry_run:
+            # Save the client credentials (in relation data) to the paths.
+            save_etcd_credentials(reldata, key, cert, ca)
+        if is_master():
+            # Only the apiserver in the master pod connects to etcd.
+            connection_string = etcd_servers('etcd', connection_string,
+                                             ca, key, cert, dry_run)
+            events = RelationBase.from_state('etcd-events.available')
+            if events:
+                # The events etcd is used with the same client credentials.
+                context['events_connection_string'] = etcd_servers(
+                    'etcd-events', events.get_connection_string(), ca, key,
+                    cert, dry_run)
         # Update the context so the template has the etcd information.
         context.update({'etcd_dir': etcd_dir,
                         'connection_string': connection_string,
@@ -414,39 +1371,242 @@ def render_files(reldata=None):
 
     charm_dir = hookenv.charm_dir()
     rendered_kube_dir = os.path.join(charm_dir, 'files/kubernetes')
-    if not os.path.exists(rendered_kube_dir):
-        os.makedirs(rendered_kube_dir)
     rendered_manifest_dir = os.path.join(charm_dir, 'files/manifests')
-    if not os.path.exists(rendered_manifest_dir):
-        os.makedirs(rendered_manifest_dir)
 
+    master_addresses = [address for address in
+                        (leader_get('master-addresses') or '').split(',')
+                        if address]
     # Update the context with extra values, arch, manifest dir, and private IP.
-    context.update({'arch': arch(),
+    architecture = arch()
+    context.update({'arch': architecture,
+                    'haproxy_image': HAPROXY_IMAGES[architecture],
                     'master_address': leader_get('master-address'),
+                    'master_addresses': master_addresses,
+                    'apiserver_count': max(len(master_addresses), 1),
+                    'apiserver_host': apiserver_host(),
                     'manifest_directory': rendered_manifest_dir,
                     'public_address': hookenv.unit_get('public-address'),
                     'private_address': hookenv.unit_get('private-address')})
 
+    # Render the templates in memory so they can be compared before writing.
+    rendered = {}
     # Adapted from: http://kubernetes.io/docs/getting-started-guides/docker/
     target = os.path.join(rendered_kube_dir, 'docker-compose.yml')
     # Render the files/kubernetes/docker-compose.yml file that contains the
     # definition for kubelet and proxy.
-    render('docker-compose.yml', target, context)
+    rendered[target] = render('docker-compose.yml', None, context)
+    compose = yaml.safe_load(rendered[target])
+    fingerprints = {}
+    for service, definition in compose.items():
+        fingerprints[service] = fingerprint(definition)
 
-    if is_leader():
+    if 'apiserver-lb' in unit_services():
+        haproxy = os.path.join(rendered_kube_dir, 'haproxy.cfg')
+        # Render the files/kubernetes/haproxy.cfg with the masters.
+        rendered[haproxy] = render('haproxy.cfg', None, context)
+        fingerprints['apiserver-lb'] = fingerprint(compose.get('apiserver-lb'),
+                                                   rendered[haproxy])
+
+    # The files with keys and credentials are only readable by root.
+    private = {}
+    if is_master():
+        key = service_account_key()
+        if key:
+            # The masters share the key of the service account tokens.
+            private[key['path']] = key['content']
+            context['service_account_key'] = key['path']
+        for setting, name in AUTH_FILES.items():
+            if leader_get(setting):
+                # The masters share the passwords and tokens of the leader,
+                # the setup container only creates the files that are missing.
+                private[os.path.join(KUBERNETES_DIR, name)] = \
+                    leader_get(setting)
+        rendered.update(private)
         # Source: https://github.com/kubernetes/...master/cluster/images/hyperkube  # noqa
-        target = os.path.join(rendered_manifest_dir, 'master.json')
+        master = os.path.join(rendered_manifest_dir, 'master.json')
         # Render the files/manifests/master.json that contains parameters for
         # the apiserver, controller, and controller-manager
-        render('master.json', target, context)
+        rendered[master] = render('master.json', None, context)
+        # The master service restarts when the master pod manifest or the
+        # shared files change, the apiserver only reads them when it starts.
+        fingerprints['master'] = fingerprint(compose.get('master'),
+                                             rendered[master], private)
+
+    if is_leader():
         # Source: ...cluster/addons/dns/skydns-svc.yaml.in
-        target = os.path.join(rendered_manifest_dir, 'kubedns-svc.yaml')
+        svc = os.path.join(rendered_manifest_dir, 'kubedns-svc.yaml')
         # Render files/kubernetes/kubedns-svc.yaml for the DNS service.
-        render('kubedns-svc.yaml', target, context)
+        rendered[svc] = render('kubedns-svc.yaml', None, context)
         # Source: ...cluster/addons/dns/skydns-rc.yaml.in
-        target = os.path.join(rendered_manifest_dir, 'kubedns-rc.yaml')
+        rc = os.path.join(rendered_manifest_dir, 'kubedns-rc.yaml')
         # Render files/kubernetes/kubedns-rc.yaml for the DNS pod.
-        render('kubedns-rc.yaml', target, context)
+        rendered[rc] = render('kubedns-rc.yaml', None, context)
+        controller = yaml.safe_load(rendered[rc])
+        # The replicas are scaled in place so they do not change the objects.
+        controller['spec'].pop('replicas', None)
+        fingerprints['kubedns'] = fingerprint(rendered[svc], controller)
+
+    db = unitdata.kv()
+    previous = db.get('k8s.fingerprints', {})
+    changed = sorted(name for name, value in fingerprints.items()
+                     if previous.get(name) != value)
+    if dry_run:
+        return changed, fingerprints
+
+    # Pull the new images while the old containers are still running.
+    images = compose_images(compose, [service for service in unit_services()
+                                      if service in changed])
+    if is_master() and 'master' in changed:
+        images.extend(pod_images(yaml.safe_load(rendered[master])))
+    prepull_images(images)
+
+    for target, content in rendered.items():
+        if target in private:
+            atomic_write(target, content, perms=0o600)
+        else:
+            atomic_write(target, content)
+    return changed, fingerprints
+
+
+def save_etcd_credentials(reldata, key, cert, ca):
+    '''Write the etcd client credentials from the relation to the paths
+    when they changed since they were last written.'''
+    digest = fingerprint(reldata.get_client_credentials())
+    db = unitdata.kv()
+    if db.get('etcd.credentials') == digest and \
+            all(os.path.exists(path) for path in (key, cert, ca)):
+        return
+    reldata.save_client_credentials(key, cert, ca)
+    db.set('etcd.credentials', digest)
+
+
+def etcd_servers(name, connection_string, ca, key, cert, dry_run=False):
+    '''Return the connection string with the healthy etcd members that
+    answered fastest first. The order is only changed when the set of
+    healthy members changes, so it does not restart the apiserver on every
+    render. When dry_run is True the new order is not saved.'''
+    db = unitdata.kv()
+    previous = db.get('etcd.order.{0}'.format(name))
+    order, healthy = order_endpoints(split_endpoints(connection_string),
+                                     previous, ETCD_PROBE_TIMEOUT, ca, key,
+                                     cert)
+    if not dry_run:
+        db.set('etcd.order.{0}'.format(name), [order, healthy])
+    if not healthy:
+        hookenv.log('None of the {0} members answered the health check: '
+                    '{1}'.format(name, connection_string))
+    return ','.join(order)
+
+
+def prepull_images(images):
+    '''Pull the images concurrently before the services are restarted and
+    report the progress and duration in the status message.'''
+    if not images:
+        return
+    workers = hookenv.config().get('image_pull_workers')
+    start = time.time()
+
+    def progress(done, total, image):
+        status_set('maintenance', 'Pulled image {0} of {1}: {2}'.format(
+            done, total, image))
+
+    # The gcr.io images are pulled through the gcr.io cache once docker has
+    # been configured to use it, and from gcr.io when the cache fails.
+    gcr = (unitdata.kv().get('registry.images') or [None, None])[1]
+    mirrors = {'gcr.io': gcr} if gcr else {}
+    status_set('maintenance', 'Pulling {0} images.'.format(len(images)))
+    durations = pull_images(images, workers, progress, mirrors)
+    for image, seconds in durations.items():
+        hookenv.log('Pulled {0} in {1:.1f} seconds.'.format(image, seconds))
+    status_set('maintenance', 'Pulled {0} images in {1:.0f} seconds.'.format(
+        len(durations), time.time() - start))
+
+
+def fingerprint(*parts):
+    '''Return a SHA-256 digest of the parts, data structures are serialized
+    with sorted keys so the same content always has the same fingerprint.'''
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True)
+        digest.update(part.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def unit_services():
+    '''Return the names of the services that run on this unit.'''
+    if is_master():
+        services = ['master', 'proxy']
+    else:
+        services = ['kubelet', 'proxy']
+        masters = (leader_get('master-addresses') or '').split(',')
+        if len([address for address in masters if address]) > 1:
+            # Start the load balancer before the services that use it.
+            services.insert(0, 'apiserver-lb')
+    if is_state('cadvisor.available'):
+        services.append('cadvisor')
+    if hookenv.config().get('registry_cache') and \
+            registry_unit() == hookenv.local_unit():
+        # Start the caches before the services that pull through them.
+        services = REGISTRY_SERVICES + services
+    return services
+
+
+def zfs_properties(dataset):
+    '''Return the ZFS properties for the dataset from the configuration.'''
+    config = hookenv.config()
+    atime = config.get('zfs_{0}_atime'.format(dataset))
+    return {
+        'recordsize': config.get('zfs_{0}_recordsize'.format(dataset)),
+        'compression': config.get('zfs_{0}_compression'.format(dataset)),
+        'atime': 'on' if atime else 'off',
+    }
+
+
+def registry_unit():
+    '''Return the unit that runs the registry caches, the leader starts them
+    before it published the unit.'''
+    unit = leader_get('registry-unit')
+    if not unit and is_leader():
+        return hookenv.local_unit()
+    return unit
+
+
+def registry_host():
+    '''Return the unit that runs the registry caches and its private address,
+    or None and None when that unit is no longer in the cluster.'''
+    unit = registry_unit()
+    if unit == hookenv.local_unit():
+        return unit, hookenv.unit_private_ip()
+    relation_id = cluster_relation_id()
+    if unit and relation_id and unit in hookenv.related_units(relation_id):
+        address = hookenv.relation_get('private-address', unit, relation_id)
+        if address:
+            return unit, address
+    return None, None
+
+
+def registry_ready(port, host='127.0.0.1', timeout=5):
+    '''Return True when the registry on the port of the host answers.'''
+    connection = HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', '/v2/')
+        return connection.getresponse().status == 200
+    except (HTTPException, socket.error):
+        return False
+    finally:
+        connection.close()
+
+
+def restart_plan(overrides=None):
+    '''Return the services on this unit that would be restarted if the
+    files were rendered with the current configuration and the overrides.'''
+    etcd = RelationBase.from_state('etcd.available')
+    changed, _ = render_files(etcd, dry_run=True, overrides=overrides)
+    plan = [service for service in unit_services() if service in changed]
+    if is_leader() and 'kubedns' in changed:
+        plan.append('kubedns')
+    return plan
 
 
 def status_set(level, message):
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Check the collect-metrics code in lib/cadvisor.py against a stub cAdvisor.
+#
+# A local HTTP server answers the docker stats API with known samples for a
+# few containers, streamed in small chunks so the response is parsed before
+# it has all arrived. The loopback addresses 127.0.0.1 to 127.0.0.4 stand in
+# for the nodes of a cluster and the stub fails the requests for the last
+# one. The node summaries, the reported errors, the cluster percentiles and
+# the number of requests in flight are compared with the expected values.
+#
+# Usage: python3 tests/cadvisor_stub.py
+
+import json
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+from checks import check
+from checks import finish
+from checks import serve
+
+CHARM = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The nodes that answer, and the node the stub returns an error for.
+HOSTS = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+FAILING = '127.0.0.4'
+# The containers on every node and the number of stats samples of each.
+CONTAINERS = 3
+SAMPLES = 5
+WORKERS = 2
+
+
+def container_stats(index):
+    '''Return the cAdvisor stats of a container that uses (index + 1) half
+    cores, (index + 1) * 100 MiB of memory, (index + 1) KB/s of network and
+    (index + 1) * 10 bytes of filesystem.'''
+    scale = index + 1
+    stats = []
+    for second in range(SAMPLES):
+        stats.append({
+            'timestamp': '2016-10-18T13:00:{0:02d}.250000000Z'.format(second),
+            'cpu': {'usage': {'total': second * 500000000 * scale}},
+            'memory': {'usage': 2 * 100 * 1024 * 1024 * scale,
+                       'working_set': 100 * 1024 * 1024 * scale},
+            'network': {'rx_bytes': second * 600 * scale,
+                        'tx_bytes': second * 400 * scale},
+            'filesystem': [{'usage': 4 * scale}, {'usage': 6 * scale}],
+        })
+    return {'aliases': ['k8s_app.{0}'.format(index), 'id{0}'.format(index)],
+            'stats': stats}
+
+
+class StubCadvisor(BaseHTTPRequestHandler):
+    '''A cAdvisor that streams the same docker stats for every node.'''
+    in_flight = 0
+    most_in_flight = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.lock:
+            StubCadvisor.in_flight += 1
+            StubCadvisor.most_in_flight = max(StubCadvisor.most_in_flight,
+                                              StubCadvisor.in_flight)
+        try:
+            # Hold the request so the concurrent requests overlap.
+            time.sleep(0.1)
+            if self.path != '/api/v1.3/docker/':
+                return self._error(404)
+            if self.headers.get('Host', '').startswith(FAILING + ':'):
+                return self._error(500)
+            body = json.dumps({'/docker/id{0}'.format(index):
+                               container_stats(index)
+                               for index in range(CONTAINERS)})
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            for start in range(0, len(data), 100):
+                self.wfile.write(data[start:start + 100])
+                self.wfile.flush()
+        finally:
+            with self.lock:
+                StubCadvisor.in_flight -= 1
+
+    def _error(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def close(value, expected):
+    '''Return True when the value is within a rounding error of expected.'''
+    return value is not None and abs(value - expected) < 1e-6 * max(
+        1, abs(expected))
+
+
+def run_checks(cadvisor, port):
+    '''Collect the metrics from the stub and return the failures.'''
+    failures = []
+    cluster = {metric: cadvisor.Reservoir() for metric in cadvisor.METRICS}
+    summary = cadvisor.fetch_node(HOSTS[0], port, 5, cluster)
+    containers = summary['containers']
+    check(failures, sorted(containers) == ['k8s-app-{0}'.format(index)
+                                           for index in range(CONTAINERS)],
+          'the containers are named by their first alias')
+    first = containers['k8s-app-0']
+    check(failures, close(first['cpu-millicores'].get('p50'), 500),
+          'the cpu usage is 500 millicores')
+    check(failures, close(first['memory-bytes'].get('p50'),
+                          100 * 1024 * 1024),
+          'the memory is the working set')
+    check(failures, close(first['network-bytes-per-second'].get('p50'),
+                          1000),
+          'the network rate adds the received and sent bytes')
+    check(failures, close(first['filesystem-bytes'].get('p50'), 10),
+          'the filesystem usage adds the filesystems')
+    check(failures, close(summary['cpu-millicores'].get('p99'),
+                          500 * CONTAINERS),
+          'the node p99 cpu usage is the busiest container')
+
+    reports = {}
+
+    def report(host, result):
+        reports[host] = result
+
+    StubCadvisor.most_in_flight = 0
+    totals = cadvisor.collect(HOSTS + [FAILING], report, port=port,
+                              timeout=5, workers=WORKERS)
+    check(failures, sorted(reports) == sorted(HOSTS + [FAILING]),
+          'every node is reported')
+    check(failures, all(isinstance(reports[host], dict) for host in HOSTS),
+          'the nodes that answered are summarized')
+    check(failures, isinstance(reports[FAILING], Exception) and
+          '500' in str(reports[FAILING]),
+          'the node that failed is reported with the error')
+    check(failures, all(reports[host] == reports[HOSTS[0]]
+                        for host in HOSTS),
+          'the nodes with the same stats have the same summary')
+    check(failures, close(totals['memory-bytes'].get('p99'),
+                          100 * 1024 * 1024 * CONTAINERS),
+          'the cluster percentiles include every node')
+    check(failures, StubCadvisor.most_in_flight <= WORKERS,
+          'at most {0} requests were in flight: {1}'.format(
+              WORKERS, StubCadvisor.most_in_flight))
+    return failures
+
+
+def main():
+    sys.path.insert(0, os.path.join(CHARM, 'lib'))
+    import cadvisor
+
+    server = serve(ThreadingServer(('', 0), StubCadvisor))
+    try:
+        failures = run_checks(cadvisor, server.server_port)
+    finally:
+        server.shutdown()
+    return finish(failures)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+# Shared helpers of the check scripts in the tests directory. Each script
+# collects the messages of the failed checks in a list, prints the result of
+# every check as it runs and exits with the status from finish().
+
+import threading
+
+
+def check(failures, condition, message):
+    '''Print the result of one check and remember the failures.'''
+    print('{0} {1}'.format('PASS' if condition else 'FAIL', message))
+    if not condition:
+        failures.append(message)
+
+
+def serve(server):
+    '''Serve the requests of the server in a daemon thread and return the
+    server.'''
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def finish(failures):
+    '''Print the failed checks and return the exit status of the script.'''
+    for failure in failures:
+        print('FAILED: {0}'.format(failure))
+    return 1 if failures else 0
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+# Check the apiserver client in lib/kubeapi.py against a stub apiserver.
+#
+# A local HTTP/1.1 server keeps the objects of the REST API in memory and
+# counts the connections it accepts. It can fail the health check, answer a
+# create with 409 Conflict as if another client created the object first,
+# and it starts a new ready pod for every pod of a replication controller
+# that is deleted. The checks drive request, get, delete, apply, replace,
+# wait_ready, scale_down and restart_pods and compare the requests the stub
+# received with the expected ones.
+#
+# Usage: python3 tests/kubeapi_stub.py
+
+import copy
+import json
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from checks import check
+from checks import finish
+from checks import serve
+
+CHARM = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAMESPACE = '/api/v1/namespaces/kube-system'
+RC = NAMESPACE + '/replicationcontrollers/kube-dns'
+SERVICE = NAMESPACE + '/services/kube-dns'
+
+
+def manifests():
+    '''Return the namespace, controller and service of a small kubedns.'''
+    labels = {'k8s-app': 'kube-dns'}
+    return [
+        {'apiVersion': 'v1', 'kind': 'Namespace',
+         'metadata': {'name': 'kube-system'}},
+        {'apiVersion': 'v1', 'kind': 'ReplicationController',
+         'metadata': {'name': 'kube-dns', 'namespace': 'kube-system'},
+         'spec': {'replicas': 2, 'selector': labels,
+                  'template': {'metadata': {'labels': labels}}}},
+        {'apiVersion': 'v1', 'kind': 'Service',
+         'metadata': {'name': 'kube-dns', 'namespace': 'kube-system'},
+         'spec': {'clusterIP': '10.1.0.10', 'selector': labels}},
+    ]
+
+
+def ready_pod(name, labels):
+    '''Return a pod with the labels that reports Ready.'''
+    return {'kind': 'Pod',
+            'metadata': {'name': name, 'namespace': 'kube-system',
+                         'labels': dict(labels)},
+            'status': {'conditions': [{'type': 'Ready', 'status': 'True'}]}}
+
+
+class StubApiserver(BaseHTTPRequestHandler):
+    '''An apiserver that keeps the objects in memory.'''
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        '''Forget the objects, the requests and the connections.'''
+        cls.objects = {}
+        cls.requests = []
+        cls.connections = 0
+        cls.healthy = True
+        # The paths another client creates just before this client does.
+        cls.racing = set()
+        cls.versions = 0
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        with self.lock:
+            StubApiserver.connections += 1
+        super(StubApiserver, self).handle()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._record()
+        if url.path == '/healthz':
+            return self._reply(200 if self.healthy else 500, 'ok')
+        if url.path.endswith('/pods') and url.query:
+            selector = parse_qs(url.query)['labelSelector'][0]
+            return self._reply(200, {'items': self._pods(url.path,
+                                                         selector)})
+        if url.path not in self.objects:
+            return self._reply(404, {'reason': 'NotFound'})
+        self._reply(200, self.objects[url.path])
+
+    def do_POST(self):
+        body = self._record()
+        path = '{0}/{1}'.format(self.path, body['metadata']['name'])
+        if path in self.racing:
+            self.racing.discard(path)
+            self._store(path, body)
+            return self._reply(409, {'reason': 'AlreadyExists'})
+        if path in self.objects:
+            return self._reply(409, {'reason': 'AlreadyExists'})
+        self._reply(201, self._store(path, body))
+
+    def do_PUT(self):
+        body = self._record()
+        existing = self.objects.get(self.path)
+        if existing is None:
+            return self._reply(404, {'reason': 'NotFound'})
+        if body['metadata'].get('resourceVersion') != \
+                existing['metadata']['resourceVersion']:
+            return self._reply(409, {'reason': 'Conflict'})
+        if body['kind'] == 'Service' and \
+                body['spec'].get('clusterIP') != existing['spec']['clusterIP']:
+            return self._reply(422, {'reason': 'Invalid'})
+        self._reply(200, self._store(self.path, body))
+
+    def do_PATCH(self):
+        body = self._record()
+        existing = self.objects.get(self.path)
+        if existing is None:
+            return self._reply(404, {'reason': 'NotFound'})
+        existing['spec'].update(body.get('spec', {}))
+        if existing['kind'] == 'ReplicationController':
+            # The pods stop as soon as the controller is scaled.
+            existing['status'] = {'replicas': existing['spec']['replicas']}
+        self._reply(200, existing)
+
+    def do_DELETE(self):
+        self._record()
+        existing = self.objects.pop(self.path, None)
+        if existing is None:
+            return self._reply(404, {'reason': 'NotFound'})
+        if existing['kind'] == 'Pod':
+            # The controller starts a new pod in place of the deleted one.
+            name = existing['metadata']['name'] + '-new'
+            path = self.path.rsplit('/', 1)[0] + '/' + name
+            self.objects[path] = ready_pod(name,
+                                           existing['metadata']['labels'])
+        self._reply(200, {'status': 'Success'})
+
+    def _pods(self, collection, selector):
+        '''Return the pods in the collection that match the selector.'''
+        labels = dict(pair.split('=') for pair in selector.split(','))
+        return [pod for path, pod in sorted(self.objects.items())
+                if path.startswith(collection + '/') and
+                all(pod['metadata']['labels'].get(key) == value
+                    for key, value in labels.items())]
+
+    def _record(self):
+        '''Remember the request and return the decoded body.'''
+        StubApiserver.requests.append((self.command, self.path))
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _store(self, path, body):
+        '''Store the object with a new resource version and return it.'''
+        StubApiserver.versions += 1
+        body = copy.deepcopy(body)
+        body['metadata']['resourceVersion'] = str(StubApiserver.versions)
+        self.objects[path] = body
+        return body
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def check_requests(failures, kubeapi, server):
+    '''Check the plain requests over one keep-alive connection.'''
+    client = kubeapi.KubeClient(server)
+    check(failures, client.healthy(), 'the healthy apiserver is healthy')
+    check(failures, client.get(RC) is None,
+          'a missing object is returned as None')
+    check(failures, client.delete(RC) is False,
+          'deleting a missing object returns False')
+    status, reason, data = client.request('GET', RC)
+    check(failures, status == 404 and data == {'reason': 'NotFound'},
+          'the response body is decoded: {0} {1}'.format(status, data))
+    try:
+        client.patch(RC, {'spec': {'replicas': 1}})
+        raised = None
+    except kubeapi.KubeAPIError as error:
+        raised = error
+    check(failures, raised is not None and raised.status == 404,
+          'patching a missing object raises KubeAPIError with the status')
+    client.close()
+    check(failures, StubApiserver.connections == 1,
+          'the requests reuse one connection: {0}'.format(
+              StubApiserver.connections))
+
+
+def check_apply(failures, kubeapi, server):
+    '''Check that apply creates, keeps and replaces the objects.'''
+    client = kubeapi.KubeClient(server)
+    applied = client.apply(manifests())
+    check(failures, applied == [NAMESPACE, RC, SERVICE],
+          'apply creates every object in order: {0}'.format(applied))
+    del StubApiserver.requests[:]
+    applied = client.apply(manifests())
+    check(failures, applied == [] and
+          all(method == 'GET' for method, _ in StubApiserver.requests),
+          'apply leaves the existing objects alone without replace')
+
+    changed = manifests()
+    changed[1]['spec']['replicas'] = 3
+    del StubApiserver.requests[:]
+    applied = client.apply(changed, replace=True)
+    check(failures, applied == [NAMESPACE, RC, SERVICE] and
+          StubApiserver.objects[RC]['spec']['replicas'] == 3,
+          'apply replaces the existing objects with replace')
+    check(failures, ('PUT', RC) in StubApiserver.requests,
+          'the controller is replaced with its resource version')
+
+    changed[2]['spec']['clusterIP'] = '10.1.0.20'
+    del StubApiserver.requests[:]
+    client.apply(changed[2:], replace=True)
+    check(failures, StubApiserver.requests[-2:] == [
+        ('DELETE', SERVICE), ('POST', NAMESPACE + '/services')] and
+        StubApiserver.objects[SERVICE]['spec']['clusterIP'] == '10.1.0.20',
+        'a service with a new address is deleted and created again')
+
+    # Another client creates the controller between the get and the create.
+    del StubApiserver.objects[RC]
+    StubApiserver.racing.add(RC)
+    del StubApiserver.requests[:]
+    applied = client.apply(changed[1:2], replace=True)
+    methods = [method for method, _ in StubApiserver.requests]
+    replicas = StubApiserver.objects[RC]['spec']['replicas']
+    check(failures, methods == ['GET', 'POST', 'GET', 'PUT'] and
+          applied == [RC] and replicas == 3,
+          'a conflict on create is followed by a replace: {0}'.format(
+              ' '.join(methods)))
+    StubApiserver.racing.add(RC + '-other')
+    other = copy.deepcopy(changed[1])
+    other['metadata']['name'] = 'kube-dns-other'
+    check(failures, client.apply([other]) == [],
+          'a conflict on create without replace keeps the other object')
+    client.close()
+    check(failures, StubApiserver.connections == 1,
+          'apply sends every request over one connection: {0}'.format(
+              StubApiserver.connections))
+
+
+def check_controllers(failures, kubeapi, server):
+    '''Check the scaling and restart of a replication controller.'''
+    client = kubeapi.KubeClient(server)
+    client.apply(manifests())
+    labels = {'k8s-app': 'kube-dns'}
+    for name in ('kube-dns-a', 'kube-dns-b'):
+        StubApiserver.objects[NAMESPACE + '/pods/' + name] = \
+            ready_pod(name, labels)
+    remaining = client.restart_pods(RC, timeout=5, interval=0.01)
+    names = sorted(pod['metadata']['name']
+                   for pod in client.pods('kube-system', 'k8s-app=kube-dns'))
+    check(failures, remaining == [] and
+          names == ['kube-dns-a-new', 'kube-dns-b-new'],
+          'restart_pods replaces every pod: {0}'.format(names))
+    deletes = [path for method, path in StubApiserver.requests
+               if method == 'DELETE']
+    check(failures, deletes == [NAMESPACE + '/pods/kube-dns-a',
+                                NAMESPACE + '/pods/kube-dns-b'],
+          'restart_pods deletes the pods one at a time')
+    check(failures, client.scale_down(RC, timeout=5, interval=0.01) and
+          StubApiserver.objects[RC]['spec']['replicas'] == 0,
+          'scale_down scales the controller to zero')
+    check(failures, client.restart_pods(NAMESPACE + '/replicationcontrollers'
+                                        '/missing') == [],
+          'restart_pods of a missing controller does nothing')
+    client.close()
+
+
+def check_wait_ready(failures, kubeapi, server):
+    '''Check that wait_ready gives up on an unhealthy apiserver in time.'''
+    client = kubeapi.KubeClient(server)
+    StubApiserver.healthy = False
+    start = time.time()
+    ready = client.wait_ready(timeout=0.5, initial=0.1, maximum=0.2)
+    elapsed = time.time() - start
+    check(failures, not ready and 0.5 <= elapsed < 2,
+          'wait_ready times out after 0.5 seconds: {0:.2f}'.format(elapsed))
+    checks = len([path for _, path in StubApiserver.requests
+                  if path == '/healthz'])
+    check(failures, 3 <= checks <= 6,
+          'wait_ready backs off between the checks: {0}'.format(checks))
+    StubApiserver.healthy = True
+    start = time.time()
+    check(failures, client.wait_ready(timeout=5) and
+          time.time() - start < 0.5,
+          'wait_ready returns at once for a healthy apiserver')
+    client.close()
+
+
+def main():
+    sys.path.insert(0, os.path.join(CHARM, 'lib'))
+    import kubeapi
+
+    server = serve(ThreadingServer(('127.0.0.1', 0), StubApiserver))
+    url = 'http://127.0.0.1:{0}'.format(server.server_port)
+    failures = []
+    try:
+        for run in (check_requests, check_apply, check_controllers,
+                    check_wait_ready):
+            StubApiserver.reset()
+            run(failures, kubeapi, url)
+    finally:
+        server.shutdown()
+    return finish(failures)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Check the registry cache handlers in reactive/k8s.py with local registry
+# stand-ins.
+#
+# Two HTTP servers on consecutive local ports answer the registry API check
+# the way the Docker Hub and gcr.io caches on the leader do. The charm is
+# loaded with the fake modules of tests/benchmark_hooks.py for a leader that
+# publishes the caches and a running node with a peer relation. The checks
+# follow the addresses from the leader to the docker daemon flags and the
+# image pulls of the node, check that the gcr.io images fall back to gcr.io
+# when the cache fails and that the node only restarts docker in its rolling
+# restart slot. A new leader keeps the caches on the unit that runs them
+# until that unit leaves the cluster.
+#
+# Usage: python3 tests/registry_cache.py
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import benchmark_hooks  # noqa
+
+from checks import check  # noqa
+from checks import finish  # noqa
+from checks import serve  # noqa
+
+
+class StubRegistry(BaseHTTPRequestHandler):
+    '''A registry that only answers the API version check.'''
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        StubRegistry.requests.append((self.server.server_port, self.path))
+        status = 200 if self.path == '/v2/' else 404
+        self.send_response(status)
+        self.send_header('Docker-Distribution-API-Version', 'registry/2.0')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+def registry_servers():
+    '''Start the registry stand-ins on two consecutive ports and return
+    them.'''
+    for _ in range(20):
+        first = HTTPServer(('127.0.0.1', 0), StubRegistry)
+        try:
+            second = HTTPServer(('127.0.0.1', first.server_port + 1),
+                                StubRegistry)
+        except OSError:
+            first.server_close()
+            continue
+        return [serve(first), serve(second)]
+    raise RuntimeError('No two consecutive ports are free.')
+
+
+def closed_port():
+    '''Return a local port that nothing listens on.'''
+    connection = socket.socket()
+    connection.bind(('127.0.0.1', 0))
+    port = connection.getsockname()[1]
+    connection.close()
+    return port
+
+
+def check_leader(failures, root, port):
+    '''Publish the caches on a leader and configure its docker daemon, return
+    the leader data.'''
+    unit = benchmark_hooks.Unit(root, True)
+    unit.config['registry_cache'] = True
+    unit.states.add('registry.available')
+    k8s = benchmark_hooks.load_charm(unit, root)
+    services = k8s.unit_services()
+    check(failures, services[:2] == ['registry', 'registry-gcr'],
+          'the leader starts the caches first: {0}'.format(services))
+
+    unit.config['registry_cache_port'] = closed_port()
+    k8s.publish_registry_cache()
+    check(failures, unit.leader_data.get('registry-unit') == 'kubernetes/0',
+          'the leader publishes the unit that runs the caches')
+    k8s.publish_registry_cache()
+    check(failures, not unit.leader_data.get('registry-address'),
+          'the caches are not published before they answer')
+
+    unit.config['registry_cache_port'] = port
+    k8s.publish_registry_cache()
+    hub = '10.0.0.1:{0}'.format(port)
+    gcr = '10.0.0.1:{0}'.format(port + 1)
+    check(failures, unit.leader_data.get('registry-address') == hub and
+          unit.leader_data.get('gcr-registry-address') == gcr,
+          'the leader publishes the caches that answer')
+    check(failures, (port, '/v2/') in StubRegistry.requests and
+          (port + 1, '/v2/') in StubRegistry.requests,
+          'both caches were checked on the registry API')
+
+    unit.leader_data['restart-batch'] = 'kubernetes/1'
+    k8s.configure_registry_mirror()
+    check(failures, 'docker.restart' not in unit.states,
+          'the leader does not restart docker during a rolling restart')
+    unit.leader_data['restart-batch'] = ''
+    k8s.configure_registry_mirror()
+    check(failures, 'docker.restart' in unit.states and
+          unit.docker_opts.get('registry-mirror') == ['http://' + hub] and
+          unit.docker_opts.get('insecure-registry') == [hub, gcr],
+          'the leader configures docker with the caches')
+    return dict(unit.leader_data)
+
+
+def check_node(failures, root, leader_data, port, closed):
+    '''Configure a running node with the published caches.'''
+    unit = benchmark_hooks.Unit(root, False)
+    unit.leader_data = dict(leader_data)
+    # The services of the node are already running.
+    unit.kv['k8s.fingerprints'] = {'kubelet': 'running'}
+    unit.states.update(['kubelet.available', 'proxy.available'])
+    k8s = benchmark_hooks.load_charm(unit, root)
+    local = {}
+
+    def relation_set(relation_id=None, relation_settings=None, **kwargs):
+        local.update(relation_settings or {}, **kwargs)
+
+    k8s.hookenv.relation_ids = lambda name=None: ['cluster:1']
+    k8s.hookenv.related_units = lambda relation_id=None: ['kubernetes/0']
+    k8s.hookenv.relation_get = \
+        lambda attribute=None, unit=None, rid=None: dict(local)
+    k8s.hookenv.relation_set = relation_set
+
+    k8s.configure_registry_mirror()
+    check(failures, 'docker.restart' not in unit.states and
+          not unit.docker_opts and local.get('restart-request'),
+          'the node asks for a rolling restart slot before restarting docker')
+
+    unit.leader_data['restart-batch'] = 'kubernetes/1'
+    k8s.configure_registry_mirror()
+    hub = '10.0.0.1:{0}'.format(port)
+    gcr = '10.0.0.1:{0}'.format(port + 1)
+    check(failures, 'docker.restart' in unit.states and
+          unit.docker_opts.get('registry-mirror') == ['http://' + hub],
+          'the node restarts docker in its slot')
+
+    # The docker layer restarted the daemon.
+    unit.states.discard('docker.restart')
+    k8s.use_registry_mirror()
+    check(failures, 'kubelet.available' in unit.states,
+          'the services are not restarted to use the caches')
+    check(failures, not k8s.restart_pending(),
+          'the node does not ask for another restart slot')
+    k8s.render_files()
+    compose = os.path.join(root, 'charm', 'files', 'kubernetes',
+                           'docker-compose.yml')
+    with open(compose) as stream:
+        content = stream.read()
+    check(failures, 'gcr.io/google_containers/hyperkube' in content and
+          gcr not in content,
+          'the services keep the gcr.io image names')
+
+    # Record the docker commands, the pulls from the gcr.io cache fail when
+    # the cache address is changed to a closed port.
+    log = os.path.join(root, 'docker.log')
+    with open(os.path.join(root, 'bin', 'docker'), 'w') as stream:
+        stream.write('#!/bin/sh\necho "$@" >> {0}\ncase "$*" in\n'
+                     '  *:{1}/*) exit 1;;\nesac\n'.format(log, closed))
+    image = 'gcr.io/google_containers/pause-amd64:3.0'
+    k8s.prepull_images([image])
+    with open(log) as stream:
+        commands = stream.read().splitlines()
+    check(failures, commands == [
+        'pull {0}/google_containers/pause-amd64:3.0'.format(gcr),
+        'tag {0}/google_containers/pause-amd64:3.0 {1}'.format(gcr, image)],
+        'the gcr.io images are pulled through the cache and tagged')
+    unit.kv['registry.images'] = [hub, '10.0.0.1:{0}'.format(closed)]
+    os.remove(log)
+    k8s.prepull_images([image])
+    with open(log) as stream:
+        commands = stream.read().splitlines()
+    check(failures, commands[-1] == 'pull {0}'.format(image),
+          'the gcr.io images are pulled from gcr.io when the cache fails')
+    k8s.finish_restart()
+    check(failures, local.get('restart-done') == local.get('restart-request'),
+          'the node tells the leader it restarted')
+
+
+def check_new_leader(failures, root, leader_data):
+    '''Check that a new leader keeps the caches on the unit that runs them
+    and only moves them when that unit left.'''
+    unit = benchmark_hooks.Unit(root, True)
+    unit.config['registry_cache'] = True
+    unit.private_address = '10.0.0.3'
+    unit.leader_data = dict(leader_data)
+    unit.kv['k8s.services'] = ['master', 'proxy']
+    unit.states.add('kubelet.available')
+    k8s = benchmark_hooks.load_charm(unit, root)
+    peers = ['kubernetes/0', 'kubernetes/1']
+    k8s.hookenv.local_unit = lambda: 'kubernetes/2'
+    k8s.hookenv.relation_ids = lambda name=None: ['cluster:1']
+    k8s.hookenv.related_units = lambda relation_id=None: list(peers)
+    k8s.hookenv.relation_get = \
+        lambda attribute=None, unit=None, rid=None: '10.0.0.1'
+    check(failures, 'registry' not in k8s.unit_services(),
+          'the new leader does not start the caches')
+    k8s.publish_registry_cache()
+    k8s.registry_unit_changed()
+    check(failures, unit.leader_data == leader_data and
+          'kubelet.available' in unit.states,
+          'the cache addresses stay the same after a leadership change')
+
+    peers.remove('kubernetes/0')
+    k8s.publish_registry_cache()
+    check(failures, unit.leader_data.get('registry-unit') == 'kubernetes/2'
+          and not unit.leader_data.get('registry-address'),
+          'the leader takes the caches over when their unit left')
+    k8s.registry_unit_changed()
+    check(failures, 'registry' in k8s.unit_services() and
+          'kubelet.available' not in unit.states,
+          'the leader renders its services again to start the caches')
+
+
+def main():
+    sys.path.insert(0, os.path.join(benchmark_hooks.CHARM, 'lib'))
+    servers = registry_servers()
+    port = servers[0].server_port
+    failures = []
+    for name in ('leader', 'node', 'new leader'):
+        root = tempfile.mkdtemp(prefix='k8s-registry-')
+        try:
+            with benchmark_hooks.charm_environment(root):
+                if name == 'leader':
+                    leader_data = check_leader(failures, root, port)
+                elif name == 'node':
+                    check_node(failures, root, leader_data, port,
+                               closed_port())
+                else:
+                    check_new_leader(failures, root, leader_data)
+        finally:
+            shutil.rmtree(root)
+    for server in servers:
+        server.shutdown()
+    return finish(failures)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
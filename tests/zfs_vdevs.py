@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Check the ZFS dataset layout of lib/zfs.py on a pool of file-backed vdevs.
+#
+# A raidz pool of three sparse files is created with its root dataset mounted
+# at a temporary /srv/kubernetes the way layer:storage mounts the real pool.
+# The kubelet and docker datasets are created on top of directories that
+# already hold files, the properties are tuned twice to check that unchanged
+# values are not set again, and the ARC limit is written to temporary copies
+# of the module parameter and modprobe files. The pool and the files are
+# destroyed at the end. The script must run as root on a machine with the
+# ZFS utilities and kernel module (apt install zfsutils-linux).
+#
+# Usage: sudo python3 tests/zfs_vdevs.py [--size 256M]
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from checks import check
+from checks import finish
+
+CHARM = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROPERTIES = {'recordsize': '16K', 'compression': 'lz4', 'atime': 'off'}
+
+
+def run_checks(zfs, pool, root):
+    '''Run the layout checks on the pool and return the failures.'''
+    failures = []
+    kubernetes = os.path.join(root, 'srv', 'kubernetes')
+    check(failures, zfs.dataset_of(kubernetes) == pool,
+          'the pool holds {0}'.format(kubernetes))
+    check(failures, zfs.dataset_of(root) is None,
+          'a directory that is not on ZFS has no dataset')
+    changed = zfs.set_properties(pool, PROPERTIES)
+    check(failures, sorted(changed) == sorted(PROPERTIES),
+          'the changed properties are set: {0}'.format(changed))
+    check(failures, zfs.set_properties(pool, PROPERTIES) == [],
+          'unchanged properties are not set again')
+
+    kubelet = os.path.join(root, 'var', 'lib', 'kubelet')
+    os.makedirs(kubelet)
+    with open(os.path.join(kubelet, 'kubeconfig'), 'w') as stream:
+        stream.write('kubeconfig\n')
+    moved = zfs.create_dataset(pool + '/kubelet', kubelet, PROPERTIES)
+    check(failures, moved == kubelet + '.pre-zfs',
+          'the existing kubelet files are moved aside')
+    zfs.restore_files(moved, kubelet)
+    check(failures, zfs.dataset_of(kubelet) == pool + '/kubelet',
+          'the kubelet dataset is mounted')
+    check(failures, os.path.isfile(os.path.join(kubelet, 'kubeconfig')) and
+          not os.path.exists(moved), 'the kubelet files are restored')
+    check(failures, zfs.get_properties(pool + '/kubelet', sorted(PROPERTIES))
+          == PROPERTIES, 'the kubelet dataset has the properties')
+
+    docker = os.path.join(root, 'var', 'lib', 'docker')
+    os.makedirs(docker)
+    check(failures, zfs.create_dataset(pool + '/docker', docker,
+                                       PROPERTIES) is None,
+          'an empty docker directory is not moved')
+    check(failures, zfs.dataset_exists(pool + '/docker'),
+          'the docker dataset exists')
+    check(failures, not zfs.dataset_exists(pool + '/missing'),
+          'a missing dataset does not exist')
+
+    parameters = os.path.join(root, 'parameters')
+    os.makedirs(parameters)
+    with open(os.path.join(parameters, 'zfs_arc_max'), 'w') as stream:
+        stream.write('0\n')
+    modprobe = os.path.join(root, 'zfs-arc.conf')
+    size = 512 * 1024 * 1024
+    check(failures, zfs.set_arc_max(size, parameters, modprobe),
+          'the ARC limit is changed')
+    check(failures, not zfs.set_arc_max(size, parameters, modprobe),
+          'the same ARC limit is not written again')
+    with open(modprobe) as stream:
+        check(failures, str(size) in stream.read(),
+              'the ARC limit is kept for the next module load')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the ZFS layout on file-backed vdevs.')
+    parser.add_argument('--size', default='256M',
+                        help='The size of each sparse vdev file.')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.join(CHARM, 'lib'))
+    import zfs
+
+    root = tempfile.mkdtemp(prefix='k8s-zfs-')
+    pool = 'k8stest{0}'.format(os.getpid())
+    vdevs = [os.path.join(root, 'vdev{0}'.format(i)) for i in range(3)]
+    for vdev in vdevs:
+        subprocess.check_call(['truncate', '-s', args.size, vdev])
+    mountpoint = os.path.join(root, 'srv', 'kubernetes')
+    subprocess.check_call(['zpool', 'create', '-m', mountpoint, pool,
+                           'raidz'] + vdevs)
+    try:
+        failures = run_checks(zfs, pool, root)
+    finally:
+        subprocess.call(['zpool', 'destroy', '-f', pool])
+        shutil.rmtree(root)
+    return finish(failures)
+
+
+if __name__ == '__main__':
+    sys.exit(main())